@@ -98,11 +98,11 @@ class Segments:
 
         def segment_type(arg_string):
 
-            factory = segments.SegmentFactory()
+            registry = segments.segment_registry()
             name_list = {cls.__name__.lower(): cls.__name__
-                         for cls in factory.segment_subclasses.values()}
+                         for cls in registry.values()}
             # Get the class that's handling unknown segments
-            unknown = factory.segment_subclasses[None]
+            unknown = registry.unknown
             name_list[unknown.__name__.lower()] = unknown.__name__
 
             segment_list = []
@@ -0,0 +1,256 @@
+
+"""Fuzzing and stress tests for the parsers
+
+Objects from a synthetic image are mutated (bit flips, bad segment
+lengths, truncation, splices) and parsed, along with some hand made worst
+cases: deep nesting, the most segments that fit and a looping AUM chain.
+Each case is timed and its peak memory measured so the worst cost per byte
+of input shows up. Parsing should never raise; anything that does is
+reported as a crash.
+"""
+
+import io
+import mmap
+import random
+import time
+import traceback
+import tracemalloc
+
+from prodigyclassic.bench import synth
+from prodigyclassic.stage import segments, stagefile, structures
+
+
+# Largest object the header's length field can describe
+MAX_OBJECT = 0xffff
+_segment_hdr = synth._segment_hdr
+_object_hdr_size = synth._object_hdr_size
+
+
+def walk(factory, obj, render=False):
+    """Parse an object and everything imbedded in it
+
+    Returns (segments, deepest nesting). With render each segment is also
+    turned into text the way view does it.
+    """
+    count = depth = 0
+    pending = [obj]
+    while pending:
+        current = pending.pop()
+        depth = max(depth, current.depth)
+        for segment in factory.parse_segments(current):
+            count += 1
+            if render:
+                str(segment)
+            if isinstance(segment, segments.ImbeddedObjectSegment):
+                pending.append(segment.object)
+    return count, depth
+
+
+def segment_offsets(body):
+    offsets = []
+    pos = 0
+    while pos + _segment_hdr.size <= len(body):
+        st, sl = _segment_hdr.unpack_from(body, pos)
+        offsets.append(pos)
+        if sl < _segment_hdr.size:
+            break
+        pos += sl
+    return offsets
+
+
+class Mutator:
+    def __init__(self, rnd):
+        self.rnd = rnd
+
+    def flip_bits(self, body):
+        body = bytearray(body)
+        for dummy in range(self.rnd.randint(1, 8)):
+            i = self.rnd.randrange(len(body))
+            body[i] ^= 1 << self.rnd.randrange(8)
+        return bytes(body)
+
+    def random_bytes(self, body):
+        body = bytearray(body)
+        i = self.rnd.randrange(len(body))
+        n = self.rnd.randint(1, 16)
+        body[i:i + n] = self.rnd.randbytes(n)
+        return bytes(body)
+
+    def bad_length(self, body):
+        offsets = segment_offsets(body)
+        if not offsets:
+            return self.random_bytes(body)
+        pos = self.rnd.choice(offsets)
+        sl = self.rnd.choice((0, 1, 2, 3, 4, 0xffff,
+                              self.rnd.randrange(0x10000)))
+        body = bytearray(body)
+        body[pos + 1:pos + 3] = sl.to_bytes(2, 'little')
+        return bytes(body)
+
+    def bad_type(self, body):
+        offsets = segment_offsets(body)
+        if not offsets:
+            return self.random_bytes(body)
+        body = bytearray(body)
+        body[self.rnd.choice(offsets)] = self.rnd.randrange(0x100)
+        return bytes(body)
+
+    def truncate(self, body):
+        return body[:self.rnd.randrange(len(body))]
+
+    def splice(self, body):
+        i = self.rnd.randrange(len(body))
+        j = self.rnd.randrange(len(body))
+        n = self.rnd.randint(1, 64)
+        return body[:i] + body[j:j + n] + body[i:]
+
+    def names(self):
+        return [name for name in dir(self.__class__)
+                if not name.startswith('_') and name != 'names']
+
+    def __call__(self, body):
+        if not body:
+            return self.rnd.randbytes(self.rnd.randint(1, 32))
+        for dummy in range(self.rnd.randint(1, 3)):
+            body = getattr(self, self.rnd.choice(self.names()))(body) or b'\0'
+        return body
+
+
+def deep_object(depth=None, limit=MAX_OBJECT):
+    """An object with imbedded objects nested as deep as they'll go"""
+    body = synth.make_segment(0x61, b'\0')
+    level = 0
+    while depth is None or level < depth:
+        inner = synth.make_object('DP{0:06d}OBJ'.format(level), body)
+        wrapped = synth.make_segment(
+            segments.ImbeddedObjectSegment._segment_type, inner)
+        if len(wrapped) + _object_hdr_size > limit:
+            break
+        body = wrapped
+        level += 1
+    return synth.make_object('DEEP0000PGM', body)
+
+
+def many_segments(limit=MAX_OBJECT):
+    """An object of nothing but empty segments"""
+    count = (limit - _object_hdr_size) // _segment_hdr.size
+    return synth.make_object('MANY0000PGM', synth.make_segment(0x71, b'') *
+                             count)
+
+
+def looping_image(objects=20):
+    """A small image whose first object's chain loops back on itself
+
+    Returns the image's bytes.
+    """
+    generator = synth.Generator(objects=objects, payload=(200, 400))
+    stage_writer = generator.build()
+    first = stage_writer.startids[0]
+    for aum in stage_writer.AUMaps:
+        AUid = first
+        while aum.table[AUid] != structures.AUM.EolEntryValue:
+            AUid = aum.table[AUid]
+        aum.table[AUid] = first
+    image = io.BytesIO()
+    stage_writer.write(image)
+    return image.getvalue()
+
+
+class Fuzzer:
+    def __init__(self, seed=1, factory=None, render=False):
+        self.rnd = random.Random(seed)
+        self.mutate = Mutator(self.rnd)
+        self.factory = factory or segments.SegmentFactory()
+        self.render = render
+        self.cases = []
+        self.crashes = []
+
+    def measure(self, name, func, size):
+        """Time func() and measure its peak memory
+
+        func returns a dict of anything else worth keeping. Exceptions are
+        crashes.
+        """
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            info = func()
+            error = None
+        except Exception:
+            info = {}
+            error = traceback.format_exc()
+        seconds = time.perf_counter() - start
+        dummy, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        case = dict(info, name=name, size=size, seconds=seconds, peak=peak,
+                    error=error)
+        self.cases.append(case)
+        if error:
+            self.crashes.append(case)
+        return case
+
+    def parse_case(self, name, data):
+        def parse():
+            obj = structures.Object()
+            try:
+                obj.unpack(data)
+            except structures.StructureException:
+                return {'rejected': True}
+            count, depth = walk(self.factory, obj, self.render)
+            return {'segments': count, 'depth': depth}
+        return self.measure(name, parse, len(data))
+
+    def chain_case(self, data):
+        def read():
+            stage_map = mmap.mmap(-1, len(data))
+            stage_map.write(data)
+            stage = stagefile.StageFile(stage_map)
+            stage.load()
+            try:
+                stage.get_object(0)
+            except structures.AUchainTooLongError:
+                return {'rejected': True}
+            raise AssertionError('looping chain was read')
+        return self.measure('looping_chain', read, len(data))
+
+    def run(self, objects, iterations):
+        """Mutate and parse objects (their bytes) iterations times"""
+        for i in range(iterations):
+            data = self.rnd.choice(objects)
+            body = self.mutate(data[_object_hdr_size:])
+            body = body[:MAX_OBJECT - _object_hdr_size]
+            # Mostly keep the header right so the segments get parsed
+            if self.rnd.random() < 0.9:
+                mutated = data[:13] + (_object_hdr_size + len(body)).to_bytes(
+                    2, 'little') + data[15:_object_hdr_size] + body
+            else:
+                mutated = self.mutate(data[:_object_hdr_size]) + body
+            self.parse_case('mutated', mutated)
+
+        self.parse_case('deep_nesting', deep_object())
+        self.parse_case('many_segments', many_segments())
+        self.chain_case(looping_image())
+        return self.summary()
+
+    def summary(self):
+        parsed = [case for case in self.cases if case['size']]
+
+        def worst(key):
+            case = max(parsed, key=lambda c: c[key] / c['size'])
+            return {'per_byte': case[key] / case['size'], 'name': case['name'],
+                    'size': case['size'], key: case[key]}
+
+        per_byte = sorted(case['seconds'] / case['size'] for case in parsed)
+        return {
+            'cases': len(self.cases),
+            'rejected': sum(1 for case in self.cases
+                            if case.get('rejected')),
+            'crashes': len(self.crashes),
+            'median_seconds_per_byte': per_byte[len(per_byte) // 2],
+            'worst_seconds': worst('seconds'),
+            'worst_peak': worst('peak'),
+            'special': {case['name']: {key: case.get(key) for key in
+                                       ('size', 'seconds', 'peak',
+                                        'segments', 'depth', 'rejected')}
+                        for case in self.cases if case['name'] != 'mutated'},
+        }
@@ -0,0 +1,245 @@
+
+"""Timed benchmarks over a STAGE.DAT image
+
+Each benchmark is called in a loop long enough (min_time) for the timer
+and the machine's jitter not to matter, the way timeit.Timer.autorange
+picks its number. That's done repeat times and the best and median times
+per call are kept. Results are plain dicts that go to and from JSON so a
+run can be compared with a stored baseline.
+"""
+
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from prodigyclassic import hexdump
+from prodigyclassic.stage import segments, stagefile
+
+
+def open_stage(filename):
+    f = open(filename, 'rb')
+    stage = stagefile.StageFile(stagefile.map_file(f))
+    stage.load()
+    return stage
+
+
+def all_segments(factory, obj):
+    """Yield every segment of an object, imbedded objects' too"""
+    pending = [obj]
+    while pending:
+        for segment in factory.parse_segments(pending.pop()):
+            yield segment
+            if isinstance(segment, segments.ImbeddedObjectSegment):
+                pending.append(segment.object)
+
+
+class Suite:
+    """The benchmarks for one image
+
+    Benchmarks are the bench_* methods. Each returns the number of items
+    it went through, which makes the rates in the results.
+    """
+
+    def __init__(self, filename, stageutl=None, repeat=3, min_time=0.2):
+        self.filename = filename
+        self.stageutl = stageutl
+        self.repeat = repeat
+        self.min_time = min_time
+        self._stage = None
+        self._objects = None
+
+    @classmethod
+    def names(cls):
+        return [name[len('bench_'):] for name in dir(cls)
+                if name.startswith('bench_')]
+
+    # Shared setup, not timed
+
+    @property
+    def stage(self):
+        if self._stage is None:
+            self._stage = open_stage(self.filename)
+        return self._stage
+
+    @property
+    def objects(self):
+        if self._objects is None:
+            self._objects = [self.stage.get_object(i)
+                             for i in range(self.stage.dir.inuse)]
+        return self._objects
+
+    # The benchmarks
+
+    def bench_load(self):
+        stage = open_stage(self.filename)
+        return stage.dir.inuse
+
+    def bench_read_chain(self):
+        stage = open_stage(self.filename)
+        for i in range(stage.dir.inuse):
+            entry = stage.dir.get_entry(i)
+            stage.read_chain(stage.AUM.get_chain(entry.startid))
+        return stage.dir.inuse
+
+    def _names(self):
+        # Shuffled so neither lookup gets the file order for free
+        names = [self.stage.dir.get_entry(i).id.name
+                 for i in range(self.stage.dir.inuse)]
+        random.Random(1).shuffle(names)
+        return names
+
+    def bench_get_object_loop(self):
+        names = self._names()
+        stage = open_stage(self.filename)
+        for name in names:
+            stage.get_object(stage.dir.get_index(name))
+        return len(names)
+
+    def bench_get_objects(self):
+        names = self._names()
+        stage = open_stage(self.filename)
+        stage.get_objects(names)
+        return len(names)
+
+    def bench_get_objects_raw(self):
+        names = self._names()
+        stage = open_stage(self.filename)
+        for view in stage.get_objects(names, raw=True):
+            view.release()
+        return len(names)
+
+    def bench_parse_segments(self):
+        factory = segments.SegmentFactory()
+        count = 0
+        for obj in self.objects:
+            for segment in all_segments(factory, obj):
+                count += 1
+        return count
+
+    def bench_hexdump(self):
+        dump = hexdump.HexDump()
+        for obj in self.objects:
+            dump(obj.get_data(True))
+        return len(self.objects)
+
+    def bench_conditions(self):
+        # conditions lives next to stageutl, not in the package
+        import conditions
+        args = conditions.Objects.get_parser().parse_args(
+            ['--obj-type', '4,0xc', '--obj-name', '*PGM'])
+        vars(args).update(vars(conditions.Segments.get_parser().parse_args(
+            ['--seg-type', 'PresentationDataSegment,0x61',
+             '--seg-min-size', '16'])))
+        factory = segments.SegmentFactory()
+        for i, obj in enumerate(self.objects):
+            entry = self.stage.dir.get_entry(i)
+            if not conditions.Objects.check(args, entry):
+                continue
+            for segment in all_segments(factory, obj):
+                conditions.Segments.check(args, segment)
+        return len(self.objects)
+
+    def _stageutl(self, *command):
+        subprocess.run([sys.executable, self.stageutl] + list(command),
+                       stdout=subprocess.DEVNULL, check=True)
+        return self.stage.dir.inuse
+
+    def bench_cli_startup(self):
+        # Cold start: imports, argument parsing and the segment registry
+        self._stageutl('list-segment-types')
+        return 1
+
+    def bench_cli_dir(self):
+        return self._stageutl('dir', self.filename)
+
+    def bench_cli_view(self):
+        return self._stageutl('view', self.filename)
+
+    def bench_cli_extract(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            return self._stageutl('extract', '--segment', '--output-dir',
+                                  output_dir, self.filename)
+
+    @staticmethod
+    def time_loops(func, loops):
+        start = time.perf_counter()
+        for dummy in range(loops):
+            func()
+        return time.perf_counter() - start
+
+    def autorange(self, func):
+        """Return how many calls of func take at least min_time
+
+        1, 2, 5, 10, 20, 50, ... as timeit.Timer.autorange does.
+        """
+        i = 1
+        while True:
+            for loops in (i, 2 * i, 5 * i):
+                if self.time_loops(func, loops) >= self.min_time:
+                    return loops
+            i *= 10
+
+    def run(self, names=None, progress=None):
+        """Run the benchmarks; returns name -> result dict"""
+        results = {}
+        for name in names or self.names():
+            if name.startswith('cli_') and not self.stageutl:
+                continue
+            func = getattr(self, 'bench_' + name)
+            # Warm up (and the shared setup) outside the timing
+            items = func()
+            loops = self.autorange(func)
+            times = []
+            for dummy in range(self.repeat):
+                times.append(self.time_loops(func, loops) / loops)
+            best = min(times)
+            results[name] = {
+                'best': round(best, 6),
+                'median': round(statistics.median(times), 6),
+                'runs': len(times),
+                'loops': loops,
+                'items': items,
+                'items_per_second': round(items / best, 1) if best else None,
+            }
+            if progress:
+                progress(name, results[name])
+        return results
+
+
+def environment():
+    return {'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'system': platform.system()}
+
+
+def image_info(filename):
+    stage = open_stage(filename)
+    return {'file': os.path.basename(filename),
+            'size': os.path.getsize(filename),
+            'objects': stage.dir.inuse,
+            'au_size': stage.prologue.auquantasize,
+            'aus': stage.prologue.maxmapentries}
+
+
+def compare(results, baseline, tolerance=0.10):
+    """Compare results with a baseline's
+
+    Returns [(name, baseline best, best, ratio, regressed)] for the
+    benchmarks in both. A benchmark regressed when it's more than
+    tolerance slower.
+    """
+    rows = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base or not base['best']:
+            continue
+        ratio = result['best'] / base['best']
+        rows.append((name, base['best'], result['best'], ratio,
+                     ratio > 1 + tolerance))
+    return rows
@@ -0,0 +1,223 @@
+
+"""Synthetic STAGE.DAT images for benchmarking
+
+The objects are made of the same structures as a real image (object
+headers, segments, imbedded objects) but the contents are random. Nothing
+here comes from a real image.
+"""
+
+import io
+import random
+import struct
+
+from prodigyclassic.stage import segments, structures, writer
+
+
+_segment_hdr = struct.Struct('<BH')
+# The object header after the object ID
+_object_hdr = struct.Struct('<HBBB')
+_object_hdr_size = structures.Object._format.size
+
+# NAPLPS-ish bytes for presentation data: shift out, a few drawing
+# commands and some text
+_naplps = bytes([0x0e, 0x3c, 0x7f, 0x40, 0x40, 0x31, 0x41, 0x42, 0x43,
+                 0x45, 0x46, 0x47, 0x2a, 0x40, 0x40, 0x40, 0x60, 0x60,
+                 0x60, 0x0f]) + b'PRODIGY'
+
+
+def object_id(name, location=0, type_=0xc):
+    return structures.ObjectID(name.encode(), location, type_).pack()
+
+
+def make_segment(st, payload):
+    return _segment_hdr.pack(st, len(payload) + _segment_hdr.size) + payload
+
+
+def make_object(name, body, location=0, type_=0xc, version=0x40,
+                store=0x08):
+    return (object_id(name, location, type_) +
+            _object_hdr.pack(_object_hdr_size + len(body), store, 0,
+                             version) + body)
+
+
+def _naplps_bytes(rnd, size):
+    data = bytearray()
+    while len(data) < size:
+        data += _naplps
+        data += rnd.randbytes(rnd.randrange(4, 32))
+    return bytes(data[:size])
+
+
+def _random_id(rnd):
+    return object_id('{0:02X}{1:06d}{2}'.format(
+        rnd.randrange(0x100), rnd.randrange(10 ** 6),
+        rnd.choice(('PGM', 'HDR', 'FMT', 'D'))), 0, rnd.choice((0, 4, 8)))
+
+
+# Segment kind -> (segment type, payload maker(rnd, size))
+SEGMENT_KINDS = {
+    'program_call': (segments.ProgramCallSegment._segment_type,
+                     lambda rnd, size: (b'\x01\x0d' + _random_id(rnd) +
+                                        rnd.randbytes(size % 8))),
+    'element_call': (segments.ElementCallSegment._segment_type,
+                     lambda rnd, size: b'\x01\x00\x0d' + _random_id(rnd)),
+    'page_format': (segments.PageFormatCallSegment._segment_type,
+                    lambda rnd, size: b'\x0d' + _random_id(rnd)),
+    'custom_text': (segments.CustomTextDefSegment._segment_type,
+                    lambda rnd, size: b'\x01' + _naplps_bytes(rnd, size)),
+    'presentation': (segments.PresentationDataSegment._segment_type,
+                     lambda rnd, size: (b'\x01' + size.to_bytes(3, 'little') +
+                                        _naplps_bytes(rnd, size))),
+    'program_data': (segments.ProgramDataSegment._segment_type,
+                     lambda rnd, size: b'\x00' + rnd.randbytes(size)),
+    'navigate': (segments.NavigateSegment._segment_type,
+                 lambda rnd, size: rnd.randbytes(size)),
+}
+
+DEFAULT_MIX = {'page_format': 1, 'element_call': 2, 'program_call': 1,
+               'presentation': 3, 'custom_text': 1, 'program_data': 3,
+               'navigate': 1}
+
+
+def parse_mix(spec):
+    """Parse 'kind=weight,kind=weight' into a dict"""
+    mix = {}
+    for item in spec.split(','):
+        kind, sep, weight = item.partition('=')
+        kind = kind.strip()
+        if kind not in SEGMENT_KINDS:
+            raise ValueError('unknown segment kind {!r} (not one of {})'
+                             .format(kind, ', '.join(sorted(SEGMENT_KINDS))))
+        mix[kind] = float(weight) if sep else 1.0
+    return mix
+
+
+class Generator:
+    """Build a synthetic image
+
+    objects         number of directory entries
+    segments        (min, max) segments per object
+    payload         (min, max) bytes in a segment's variable part
+    fragmentation   fraction (0-1) of the object AUs shuffled out of order
+    imbed_depth     how deep imbedded objects nest
+    imbed_rate      fraction of objects with imbedded objects
+    mix             segment kind -> weight (see SEGMENT_KINDS)
+    """
+
+    def __init__(self, objects=1000, segments=(2, 8), payload=(8, 400),
+                 fragmentation=0.0, imbed_depth=1, imbed_rate=0.2,
+                 mix=None, au_size=128, seed=1):
+        self.objects = objects
+        self.segments = segments
+        self.payload = payload
+        self.fragmentation = fragmentation
+        self.imbed_depth = imbed_depth
+        self.imbed_rate = imbed_rate
+        self.mix = mix or DEFAULT_MIX
+        self.au_size = au_size
+        self.seed = seed
+
+    def params(self):
+        return {'objects': self.objects, 'segments': list(self.segments),
+                'payload': list(self.payload),
+                'fragmentation': self.fragmentation,
+                'imbed_depth': self.imbed_depth,
+                'imbed_rate': self.imbed_rate, 'mix': self.mix,
+                'au_size': self.au_size, 'seed': self.seed}
+
+    def _body(self, rnd, depth):
+        kinds = list(self.mix)
+        weights = [self.mix[kind] for kind in kinds]
+        body = []
+        for kind in rnd.choices(kinds, weights,
+                                k=rnd.randint(*self.segments)):
+            st, maker = SEGMENT_KINDS[kind]
+            body.append(make_segment(st, maker(rnd,
+                                               rnd.randint(*self.payload))))
+        if depth > 0:
+            inner = make_object('IM{0:06d}OBJ'.format(rnd.randrange(10 ** 6)),
+                                self._body(rnd, depth - 1))
+            body.insert(rnd.randrange(len(body) + 1),
+                        make_segment(segments.ImbeddedObjectSegment
+                                     ._segment_type, inner))
+        return b''.join(body)
+
+    def make_objects(self):
+        """Return the objects as (data, status, check) for new_image()"""
+        rnd = random.Random(self.seed)
+        objects = []
+        for i in range(self.objects):
+            depth = 0
+            if self.imbed_depth and rnd.random() < self.imbed_rate:
+                depth = rnd.randint(1, self.imbed_depth)
+            name = '{0:02X}{1:06d}{2}'.format(i % 0x100, i, 'PGM')
+            data = make_object(name, self._body(rnd, depth),
+                               location=i % 4,
+                               type_=(0x4, 0x8, 0xc, 0xe)[i % 4])
+            objects.append((data, 1, i & 0xffff))
+        return objects
+
+    def build(self):
+        """Return a laid out StageWriter"""
+        objects = self.make_objects()
+        for map_width in (12, 16):
+            try:
+                return writer.new_image(objects, au_size=self.au_size,
+                                        map_width=map_width)
+            except structures.PackError:
+                if map_width == 16:
+                    raise
+
+    def write(self, f):
+        """Write the image to a binary file object; returns its length"""
+        stage_writer = self.build()
+        if not self.fragmentation:
+            return stage_writer.write(f)
+
+        moves = self._shuffle(stage_writer)
+        image = io.BytesIO()
+        stage_writer.write(image)
+        data = image.getbuffer()
+        prologue = stage_writer.prologue
+        auq = prologue.auquantasize
+
+        def offset(AUid):
+            return (prologue.austartoffset +
+                    (AUid - prologue.prologuestartid) * auq)
+
+        shuffled = bytearray(data)
+        for old, new in moves.items():
+            shuffled[offset(new):offset(new) + auq] = \
+                data[offset(old):offset(old) + auq]
+        data.release()
+        return f.write(shuffled)
+
+    def _shuffle(self, stage_writer):
+        """Move a fraction of the object AUs somewhere else
+
+        The maps and directories are fixed up to match. Returns old AUid ->
+        new AUid for the AUs that moved.
+        """
+        rnd = random.Random(self.seed + 1)
+        first = min(stage_writer.startids, default=stage_writer.end_AUid)
+        region = list(range(first, stage_writer.end_AUid))
+        picked = rnd.sample(region, int(len(region) * self.fragmentation))
+        targets = list(picked)
+        rnd.shuffle(targets)
+        moves = dict(zip(picked, targets))
+
+        for aum in stage_writer.AUMaps:
+            table = aum.table
+            new_table = list(table)
+            for old, new in moves.items():
+                value = table[old]
+                new_table[new] = moves.get(value, value)
+            # Links into moved AUs from AUs that stayed put
+            for AUid in region:
+                if AUid not in moves and table[AUid] in moves:
+                    new_table[AUid] = moves[table[AUid]]
+            aum.table = new_table
+        for directory in stage_writer.directories:
+            for entry in directory.entrylist[:directory.inuse]:
+                entry.startid = moves.get(entry.startid, entry.startid)
+        return moves
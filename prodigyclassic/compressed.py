@@ -0,0 +1,188 @@
+
+import bisect
+import collections
+import lzma
+import os
+import struct
+import zlib
+
+
+# File layout:
+#   header      magic, method, block count, length, index offset
+#   blocks      each compressed on its own
+#   index       (uncompressed offset, compressed offset, compressed length)
+#               for each block
+MAGIC = b'PCZ1'
+_header = struct.Struct('<4sB3xLQQ')
+_index_entry = struct.Struct('<QQL')
+
+METHODS = {
+    'zlib': (1, zlib.compress, zlib.decompress),
+    'lzma': (2, lzma.compress, lzma.decompress),
+}
+_decompressors = {number: decompress
+                  for number, compress, decompress in METHODS.values()}
+
+
+def is_compressed(f):
+    """Check for the magic number without moving the file position"""
+    pos = f.tell()
+    magic = f.read(len(MAGIC))
+    f.seek(pos)
+    return magic == MAGIC
+
+
+def compress(src, dst, block_size, first=0, method='zlib'):
+    """Compress file object src into dst in independent blocks
+
+    Blocks are block_size bytes, starting at offset first. (Anything before
+    first is a block of its own.) Pick these so blocks line up with AUs.
+    Returns the number of blocks.
+    """
+    number, compress_block, dummy = METHODS[method]
+    length = src.seek(0, os.SEEK_END)
+    src.seek(0)
+
+    starts = ([0] if first else []) + list(range(first, length, block_size))
+    start_pos = dst.tell()
+    dst.write(bytes(_header.size))
+    index = []
+    for i, start in enumerate(starts):
+        stop = starts[i + 1] if i + 1 < len(starts) else length
+        data = compress_block(src.read(stop - start))
+        index.append(_index_entry.pack(start, dst.tell() - start_pos,
+                                       len(data)))
+        dst.write(data)
+
+    index_offset = dst.tell() - start_pos
+    dst.write(b''.join(index))
+    end_pos = dst.tell()
+    dst.seek(start_pos)
+    dst.write(_header.pack(MAGIC, number, len(starts), length,
+                           index_offset))
+    dst.seek(end_pos)
+    return len(starts)
+
+
+class CompressedFile:
+    """Read-only random access to a compressed file
+
+    Looks enough like a read-only mmap (read, seek, tell, slicing, len,
+    size) to be used in place of one. Only the blocks touched are
+    decompressed; the last cache_blocks of them are kept.
+    """
+
+    def __init__(self, f, cache_blocks=16):
+        self.f = f
+        self.cache_blocks = cache_blocks
+        self._cache = collections.OrderedDict()
+        self._pos = 0
+        # Just for curiosity's sake
+        self.blocks_read = 0
+
+        f.seek(0)
+        (magic, number, count, self.length,
+         index_offset) = _header.unpack(f.read(_header.size))
+        if magic != MAGIC:
+            raise CompressedException('not a compressed file')
+        if number not in _decompressors:
+            raise CompressedException('unknown compression method {}'
+                                      .format(number))
+        self._decompress = _decompressors[number]
+
+        f.seek(index_offset)
+        index = f.read(count * _index_entry.size)
+        self._starts = []
+        self._blocks = []
+        for i in range(count):
+            start, offset, size = _index_entry.unpack_from(
+                index, i * _index_entry.size)
+            self._starts.append(start)
+            self._blocks.append((offset, size))
+
+    def _get_block(self, i):
+        data = self._cache.get(i)
+        if data is not None:
+            self._cache.move_to_end(i)
+            return data
+        offset, size = self._blocks[i]
+        self.f.seek(offset)
+        data = self._decompress(self.f.read(size))
+        self.blocks_read += 1
+        self._cache[i] = data
+        if len(self._cache) > self.cache_blocks:
+            self._cache.popitem(last=False)
+        return data
+
+    def read_at(self, offset, size):
+        """Read size bytes at offset (less at the end of the file)"""
+        stop = min(offset + size, self.length)
+        data = []
+        while offset < stop:
+            i = bisect.bisect_right(self._starts, offset) - 1
+            block = self._get_block(i)
+            start = offset - self._starts[i]
+            piece = block[start:start + stop - offset]
+            data.append(piece)
+            offset += len(piece)
+        return b''.join(data)
+
+    # mmap look-alike
+
+    def __len__(self):
+        return self.length
+
+    def size(self):
+        return self.length
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(self.length)
+            data = self.read_at(start, max(stop - start, 0))
+            return data if step == 1 else data[::step]
+        if k < 0:
+            k += self.length
+        if not 0 <= k < self.length:
+            raise IndexError('index out of range')
+        return self.read_at(k, 1)[0]
+
+    def __setitem__(self, k, v):
+        raise TypeError('compressed files are read-only')
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.length - self._pos
+        data = self.read_at(self._pos, n)
+        self._pos += len(data)
+        return data
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence == os.SEEK_END:
+            pos += self.length
+        if not 0 <= pos <= self.length:
+            raise ValueError('seek out of range')
+        self._pos = pos
+
+    def tell(self):
+        return self._pos
+
+    def flush(self, *args):
+        raise TypeError('compressed files are read-only')
+
+    def close(self):
+        self._cache.clear()
+        self.f.close()
+
+    @property
+    def closed(self):
+        return self.f.closed
+
+
+class CompressedException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
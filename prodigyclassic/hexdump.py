@@ -1,4 +1,6 @@
 
+from prodigyclassic import instrument
+
 
 class HexDump:
     def __init__(self,
@@ -25,7 +27,8 @@ class HexDump:
         return self.dump(data)
 
     def dump(self, data):
-        return '\n'.join(self.dump_iter(data))
+        with instrument.phase('hexdump'):
+            return '\n'.join(self.dump_iter(data))
 
     def dump_iter(self, data):
 
@@ -0,0 +1,114 @@
+
+"""Counters and timers for finding out where the time goes
+
+Off by default. Hot code checks instrument.enabled before counting so
+leaving it off costs one attribute lookup:
+
+    if instrument.enabled:
+        instrument.count('aus_read')
+
+    with instrument.phase('load'):
+        ...
+
+Turn it on with enable() and get the results with report().
+"""
+
+import collections
+import contextlib
+import json
+import time
+
+
+enabled = False
+
+_counters = collections.Counter()
+# phase name -> [calls, wall seconds, CPU seconds]
+_phases = collections.defaultdict(lambda: [0, 0.0, 0.0])
+_null_phase = contextlib.nullcontext()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    _counters.clear()
+    _phases.clear()
+
+
+def count(name, n=1):
+    if enabled:
+        _counters[name] += n
+
+
+class _Phase:
+    __slots__ = ('name', 'wall', 'cpu')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        totals = _phases[self.name]
+        totals[0] += 1
+        totals[1] += time.perf_counter() - self.wall
+        totals[2] += time.process_time() - self.cpu
+        return False
+
+
+def phase(name):
+    """Context manager timing a phase (wall and CPU time)
+
+    Phases can nest; each one's time includes its inner phases'.
+    """
+    if not enabled:
+        return _null_phase
+    return _Phase(name)
+
+
+def timed(name):
+    """Decorator timing every call of a function as a phase"""
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with _Phase(name):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+def report():
+    """Return the counters and phases as a dict"""
+    return {
+        'counters': dict(sorted(_counters.items())),
+        'phases': {name: {'calls': calls, 'wall': round(wall, 6),
+                          'cpu': round(cpu, 6)}
+                   for name, (calls, wall, cpu) in sorted(_phases.items())},
+    }
+
+
+def format_report(fmt='text'):
+    if fmt == 'json':
+        return json.dumps(report(), indent=1)
+    lines = ['{0:36} {1:>8} {2:>10} {3:>10}'.format('phase', 'calls', 'wall',
+                                                  'cpu')]
+    for name, totals in report()['phases'].items():
+        lines.append('{0:36} {1[calls]:8} {1[wall]:10.4f} {1[cpu]:10.4f}'
+                     .format(name, totals))
+    lines.append('')
+    for name, value in report()['counters'].items():
+        lines.append('{0:36} {1:>8}'.format(name, value))
+    return '\n'.join(lines)
@@ -0,0 +1,220 @@
+
+"""Progress and throughput reporting for long runs
+
+The loop being measured only bumps plain counters (update()). A background
+thread works out the rates every interval seconds and sends them to any of
+stderr, a Prometheus text format file or a local HTTP endpoint.
+"""
+
+import os
+import sys
+import threading
+import time
+
+
+class Metrics:
+    def __init__(self, total=None, interval=5.0, stderr=False,
+                 prom_file=None, http_port=None, job=None):
+        # Number of objects expected, for the ETA
+        self.total = total
+        self.interval = interval
+        self.stderr = stderr
+        self.prom_file = prom_file
+        self.http_port = http_port
+        self.job = job
+
+        self.objects = 0
+        self.segments = 0
+        self.bytes = 0
+        # Queue name -> depth, set by whoever owns the queue
+        self.queues = {}
+
+        self._start = None
+        self._last = None
+        self._rates = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+
+    @property
+    def enabled(self):
+        return bool(self.stderr or self.prom_file or self.http_port)
+
+    def update(self, objects=0, segments=0, nbytes=0):
+        self.objects += objects
+        self.segments += segments
+        self.bytes += nbytes
+
+    def set_queue(self, name, depth):
+        self.queues[name] = depth
+
+    def start(self):
+        self._start = self._last = (time.monotonic(), 0, 0, 0)
+        if not self.enabled:
+            return self
+        if self.http_port:
+            self._serve()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the thread and emit the final numbers"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.emit()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        return False
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.emit()
+
+    def sample(self):
+        """Work out the rates since the last sample and overall"""
+        now = time.monotonic()
+        counts = (self.objects, self.segments, self.bytes)
+        last_time, *last_counts = self._last
+        start_time = self._start[0]
+        self._last = (now,) + counts
+
+        elapsed = max(now - last_time, 1e-9)
+        overall = max(now - start_time, 1e-9)
+        rates = {
+            'objects': counts[0],
+            'segments': counts[1],
+            'bytes': counts[2],
+            'objects_per_second': (counts[0] - last_counts[0]) / elapsed,
+            'segments_per_second': (counts[1] - last_counts[1]) / elapsed,
+            'megabytes_per_second': ((counts[2] - last_counts[2]) / elapsed /
+                                     (1 << 20)),
+            'elapsed_seconds': overall,
+            'eta_seconds': None,
+        }
+        if self.total and counts[0]:
+            rates['eta_seconds'] = (max(self.total - counts[0], 0) /
+                                    (counts[0] / overall))
+        self._rates = rates
+        return rates
+
+    def emit(self):
+        rates = self.sample()
+        if self.stderr:
+            print(self.format_line(rates), file=sys.stderr, flush=True)
+        if self.prom_file:
+            temp = self.prom_file + '.tmp'
+            with open(temp, 'w') as f:
+                f.write(self.prometheus(rates))
+            os.replace(temp, self.prom_file)
+
+    def format_line(self, rates):
+        line = ['{0}/{1} objects'.format(rates['objects'],
+                                         self.total or '?'),
+                '{0:.1f} objects/s'.format(rates['objects_per_second']),
+                '{0:.1f} segments/s'.format(rates['segments_per_second']),
+                '{0:.2f} MB/s'.format(rates['megabytes_per_second'])]
+        line.extend('{0} queue {1}'.format(name, depth)
+                    for name, depth in sorted(self.queues.items()))
+        if rates['eta_seconds'] is not None:
+            line.append('ETA {0:.0f}s'.format(rates['eta_seconds']))
+        return (self.job + ': ' if self.job else '') + ', '.join(line)
+
+    def prometheus(self, rates):
+        labels = '{{job="{}"}}'.format(self.job) if self.job else ''
+        lines = []
+
+        def metric(name, kind, value, help_text, extra_labels=labels):
+            lines.append('# HELP prodigy_{0} {1}'.format(name, help_text))
+            lines.append('# TYPE prodigy_{0} {1}'.format(name, kind))
+            lines.append('prodigy_{0}{1} {2}'.format(name, extra_labels,
+                                                     value))
+
+        metric('objects_total', 'counter', rates['objects'],
+               'Objects processed')
+        metric('segments_total', 'counter', rates['segments'],
+               'Segments processed')
+        metric('bytes_total', 'counter', rates['bytes'],
+               'Object bytes processed')
+        metric('objects_per_second', 'gauge',
+               '{:.3f}'.format(rates['objects_per_second']),
+               'Objects per second over the last interval')
+        metric('segments_per_second', 'gauge',
+               '{:.3f}'.format(rates['segments_per_second']),
+               'Segments per second over the last interval')
+        metric('megabytes_per_second', 'gauge',
+               '{:.3f}'.format(rates['megabytes_per_second']),
+               'Megabytes per second over the last interval')
+        if rates['eta_seconds'] is not None:
+            metric('eta_seconds', 'gauge',
+                   '{:.1f}'.format(rates['eta_seconds']),
+                   'Estimated seconds left')
+        if self.queues:
+            lines.append('# HELP prodigy_queue_depth Items waiting')
+            lines.append('# TYPE prodigy_queue_depth gauge')
+            for name, depth in sorted(self.queues.items()):
+                queue_labels = ('{{job="{}",queue="{}"}}'.format(self.job,
+                                                                 name)
+                                if self.job else
+                                '{{queue="{}"}}'.format(name))
+                lines.append('prodigy_queue_depth{0} {1}'
+                             .format(queue_labels, depth))
+        return '\n'.join(lines) + '\n'
+
+    def _serve(self):
+        # Only imported when it's wanted; it's slow to import
+        import http.server
+
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                # Between intervals serve fresh numbers
+                body = metrics.prometheus(metrics._rates or
+                                          metrics.sample()).encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', self.http_port), Handler)
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+
+
+def add_arguments(parser):
+    """Add the options for a Metrics to an argparse parser"""
+    parser.add_argument('--metrics', action='store_true',
+                        help='report progress and throughput on stderr')
+    parser.add_argument('--metrics-file', metavar='FILE',
+                        help='keep a Prometheus text format file up to date')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help='serve Prometheus metrics on localhost')
+    parser.add_argument('--metrics-interval', type=float, default=5.0,
+                        metavar='SECONDS', help='how often to report')
+
+
+def from_args(args, total=None, job=None):
+    return Metrics(total=total, interval=args.metrics_interval,
+                   stderr=args.metrics, prom_file=args.metrics_file,
+                   http_port=args.metrics_port, job=job)
@@ -0,0 +1,633 @@
+__author__ = 'jimc'
+
+# A (partial) NAPLPS decoder and rasterizer.
+#
+# This only implements what's needed to get a reasonable picture out of the
+# payloads found in STAGE.DAT: the PDI drawing primitives, colors, mosaics
+# and cursor movement. Text is tracked (the cursor moves) but isn't drawn
+# because we don't have a font. Everything is pure Python and the output is
+# either a PPM or a PNG (via zlib), so no imaging library is needed.
+
+import math
+import struct
+import time
+import zlib
+
+
+# Code sets that can be designated into G0-G3
+PRIMARY = 'primary'             # ASCII
+SUPPLEMENTARY = 'supplementary'
+PDI = 'pdi'                     # picture description instructions
+MOSAIC = 'mosaic'
+MACRO = 'macro'
+DRCS = 'drcs'
+
+# Final bytes of the designation escape sequences
+_designations = {
+    0x42: PRIMARY,
+    0x7c: MOSAIC,
+    0x7d: SUPPLEMENTARY,
+    0x57: PDI,
+    0x20: DRCS,
+    0x21: MACRO,
+}
+
+# C0 controls
+NUL = 0x00
+APB = 0x08  # active position backward
+APF = 0x09  # active position forward
+APD = 0x0a  # active position down
+APU = 0x0b  # active position up
+CS = 0x0c   # clear screen
+APR = 0x0d  # active position return
+SO = 0x0e
+SI = 0x0f
+SS2 = 0x19
+ESC = 0x1b
+SS3 = 0x1d
+APH = 0x1e  # active position home
+
+# PDI opcodes
+RESET = 0x20
+DOMAIN = 0x21
+TEXT = 0x22
+TEXTURE = 0x23
+POINT_SET_ABS = 0x24
+POINT_SET_REL = 0x25
+POINT_ABS = 0x26
+POINT_REL = 0x27
+LINE_ABS = 0x28
+LINE_REL = 0x29
+SET_LINE_ABS = 0x2a
+SET_LINE_REL = 0x2b
+ARC_OUTLINED = 0x2c
+ARC_FILLED = 0x2d
+SET_ARC_OUTLINED = 0x2e
+SET_ARC_FILLED = 0x2f
+RECT_OUTLINED = 0x30
+RECT_FILLED = 0x31
+SET_RECT_OUTLINED = 0x32
+SET_RECT_FILLED = 0x33
+POLY_OUTLINED = 0x34
+POLY_FILLED = 0x35
+SET_POLY_OUTLINED = 0x36
+SET_POLY_FILLED = 0x37
+FIELD = 0x38
+INCR_POINT = 0x39
+INCR_LINE = 0x3a
+INCR_POLY_FILLED = 0x3b
+SET_COLOR = 0x3c
+WAIT = 0x3d
+SELECT_COLOR = 0x3e
+BLINK = 0x3f
+
+# The default color map
+PALETTE = [
+    (0x00, 0x00, 0x00), (0x00, 0x00, 0xaa), (0x00, 0xaa, 0x00),
+    (0x00, 0xaa, 0xaa), (0xaa, 0x00, 0x00), (0xaa, 0x00, 0xaa),
+    (0xaa, 0x55, 0x00), (0xaa, 0xaa, 0xaa), (0x55, 0x55, 0x55),
+    (0x55, 0x55, 0xff), (0x55, 0xff, 0x55), (0x55, 0xff, 0xff),
+    (0xff, 0x55, 0x55), (0xff, 0x55, 0xff), (0xff, 0xff, 0x55),
+    (0xff, 0xff, 0xff),
+]
+
+
+class Instruction:
+    def __init__(self, code_set, code, operands=b''):
+        self.code_set = code_set
+        self.code = code
+        self.operands = operands
+
+    def __repr__(self):
+        return ('{0}(code_set={1}, code={2:#x}, operands={3})'
+                .format(self.__class__.__name__, self.code_set, self.code,
+                        self.operands))
+
+
+class Decoder:
+    """Turn a NAPLPS byte stream into Instructions
+
+    Controls are returned with a code_set of None. Graphic characters are
+    returned with the code set they were invoked from. PDI opcodes carry
+    their (still encoded) operand bytes.
+    """
+
+    def __init__(self):
+        self.g = [PRIMARY, PDI, SUPPLEMENTARY, MOSAIC]
+        self.gl = 0
+        self.gr = 1
+
+    def decode(self, data):
+        i = 0
+        length = len(data)
+        single_shift = None
+        while i < length:
+            b = data[i]
+            i += 1
+            c = b & 0x7f
+
+            # controls (C0 and, in 8-bit mode, C1)
+            if c < 0x20:
+                if b == ESC:
+                    i = self._escape(data, i)
+                elif b == SO:
+                    self.gl = 1
+                elif b == SI:
+                    self.gl = 0
+                elif b == SS2:
+                    single_shift = 2
+                elif b == SS3:
+                    single_shift = 3
+                else:
+                    yield Instruction(None, b)
+                continue
+
+            if single_shift is not None:
+                code_set = self.g[single_shift]
+                single_shift = None
+            elif b & 0x80:
+                code_set = self.g[self.gr]
+            else:
+                code_set = self.g[self.gl]
+
+            if code_set == PDI and 0x20 <= c < 0x40:
+                # Gather the operands. They're everything up to the next
+                # byte that isn't in the 0x40-0x7f (or 0xc0-0xff) range.
+                start = i
+                while i < length and (data[i] & 0x7f) >= 0x40:
+                    i += 1
+                yield Instruction(PDI, c, bytes(d & 0x7f
+                                                for d in data[start:i]))
+            else:
+                yield Instruction(code_set, c)
+
+    def _escape(self, data, i):
+        # Collect intermediate bytes then the final byte
+        intermediates = []
+        while i < len(data) and 0x20 <= data[i] < 0x30:
+            intermediates.append(data[i])
+            i += 1
+        if i >= len(data):
+            return i
+        final = data[i]
+        i += 1
+
+        if intermediates and 0x28 <= intermediates[0] <= 0x2b:
+            g = intermediates[0] - 0x28
+            code_set = _designations.get(
+                intermediates[1] if len(intermediates) > 1 else final)
+            if code_set is not None:
+                self.g[g] = code_set
+        elif not intermediates:
+            # locking shifts
+            if final == 0x6e:    # LS2
+                self.gl = 2
+            elif final == 0x6f:  # LS3
+                self.gl = 3
+            elif final == 0x7e:  # LS1R
+                self.gr = 1
+            elif final == 0x7d:  # LS2R
+                self.gr = 2
+            elif final == 0x7c:  # LS3R
+                self.gr = 3
+        return i
+
+
+class Raster:
+    def __init__(self, width=512, height=384, background=(0, 0, 0)):
+        self.width = width
+        self.height = height
+        self.pixels = bytearray(bytes(background) * (width * height))
+
+    def clear(self, color):
+        self.pixels[:] = bytes(color) * (self.width * self.height)
+
+    def set_pixel(self, x, y, color):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            i = (y * self.width + x) * 3
+            self.pixels[i:i + 3] = bytes(color)
+
+    def hline(self, x0, x1, y, color):
+        if not 0 <= y < self.height:
+            return
+        if x0 > x1:
+            x0, x1 = x1, x0
+        x0 = max(x0, 0)
+        x1 = min(x1, self.width - 1)
+        if x0 > x1:
+            return
+        i = (y * self.width + x0) * 3
+        self.pixels[i:i + (x1 - x0 + 1) * 3] = bytes(color) * (x1 - x0 + 1)
+
+    def fill_rect(self, x0, y0, x1, y1, color):
+        if y0 > y1:
+            y0, y1 = y1, y0
+        for y in range(max(y0, 0), min(y1, self.height - 1) + 1):
+            self.hline(x0, x1, y, color)
+
+    def line(self, x0, y0, x1, y1, color):
+        # Bresenham
+        dx = abs(x1 - x0)
+        dy = -abs(y1 - y0)
+        sx = 1 if x0 < x1 else -1
+        sy = 1 if y0 < y1 else -1
+        err = dx + dy
+        while True:
+            self.set_pixel(x0, y0, color)
+            if x0 == x1 and y0 == y1:
+                break
+            e2 = 2 * err
+            if e2 >= dy:
+                err += dy
+                x0 += sx
+            if e2 <= dx:
+                err += dx
+                y0 += sy
+
+    def polyline(self, points, color, closed=False):
+        if closed and points:
+            points = points + [points[0]]
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            self.line(x0, y0, x1, y1, color)
+
+    def fill_polygon(self, points, color):
+        if len(points) < 3:
+            self.polyline(points, color)
+            return
+        ys = [y for x, y in points]
+        edges = list(zip(points, points[1:] + points[:1]))
+        for y in range(max(min(ys), 0), min(max(ys), self.height - 1) + 1):
+            # Sample at the center of the scan line, even-odd rule
+            yc = y + 0.5
+            xs = []
+            for (x0, y0), (x1, y1) in edges:
+                if (y0 <= yc) != (y1 <= yc):
+                    xs.append(x0 + (yc - y0) * (x1 - x0) / (y1 - y0))
+            xs.sort()
+            for xa, xb in zip(xs[0::2], xs[1::2]):
+                self.hline(int(math.ceil(xa - 0.5)),
+                           int(math.floor(xb - 0.5)), y, color)
+        self.polyline(points, color, closed=True)
+
+    def to_ppm(self):
+        return (b'P6\n' + '{} {}\n255\n'.format(self.width,
+                                                 self.height).encode() +
+                bytes(self.pixels))
+
+    def to_png(self):
+        def chunk(type_, data):
+            return (struct.pack('>L', len(data)) + type_ + data +
+                    struct.pack('>L', zlib.crc32(type_ + data) & 0xffffffff))
+
+        stride = self.width * 3
+        # Every row gets filter type 0 (none)
+        raw = b''.join(b'\0' + bytes(self.pixels[y * stride:(y + 1) * stride])
+                       for y in range(self.height))
+        return (b'\x89PNG\r\n\x1a\n' +
+                chunk(b'IHDR', struct.pack('>LLBBBBB', self.width,
+                                           self.height, 8, 2, 0, 0, 0)) +
+                chunk(b'IDAT', zlib.compress(raw, 6)) +
+                chunk(b'IEND', b''))
+
+    def save(self, filename, force=True):
+        """Write a PNG or PPM (by filename's extension)
+
+        Without force an existing file isn't overwritten (FileExistsError).
+        """
+        if filename.lower().endswith('.png'):
+            data = self.to_png()
+        else:
+            data = self.to_ppm()
+        with open(filename, force and 'wb' or 'xb') as f:
+            f.write(data)
+
+
+class Renderer:
+    """Execute NAPLPS on a Raster
+
+    Coordinates are fractions of the unit screen with the origin in the
+    lower left. The visible area is 1.0 wide and (height / width) high.
+    """
+
+    # How often (in instructions) to check the deadline
+    deadline_interval = 256
+
+    def __init__(self, raster=None):
+        self.raster = raster or Raster()
+        self.reset()
+
+    def reset(self):
+        self.single_len = 1
+        self.multi_len = 3
+        self.dimensions = 2
+        self.color = PALETTE[15]
+        self.background = PALETTE[0]
+        self.palette = list(PALETTE)
+        self.pos = (0.0, 0.0)
+        self.char_size = (1 / 40, 5 / 128)
+        self.field = None
+
+    def render(self, data, deadline=None):
+        """Render data, a bytes-like NAPLPS stream
+
+        deadline, if given, is a time.monotonic() value. RenderTimeout is
+        raised once it has passed.
+        """
+        for count, instruction in enumerate(Decoder().decode(data)):
+            if (deadline is not None and
+                    count % self.deadline_interval == 0 and
+                    time.monotonic() > deadline):
+                raise RenderTimeout('deadline passed after {} instructions'
+                                    .format(count))
+            self.execute(instruction)
+        return self.raster
+
+    def execute(self, instruction):
+        if instruction.code_set is None:
+            self._control(instruction.code)
+        elif instruction.code_set == PDI:
+            self._pdi(instruction.code, instruction.operands)
+        elif instruction.code_set == MOSAIC:
+            self._mosaic(instruction.code)
+        elif instruction.code_set in (PRIMARY, SUPPLEMENTARY):
+            # No font; just move along
+            self._advance(1, 0)
+
+    ### operand decoding
+
+    def _values(self, operands, length):
+        return [operands[i:i + length]
+                for i in range(0, len(operands) - length + 1, length)]
+
+    def _coord(self, value):
+        # Each byte contributes 3 bits to x and 3 bits to y (2D), or 2
+        # bits each to x, y and z (3D), most significant first. The first
+        # bit is the sign. z isn't used.
+        width = 3 if self.dimensions == 2 else 2
+        mask = (1 << width) - 1
+        x = y = 0
+        for b in value:
+            x = (x << width) | ((b >> (6 - width)) & mask)
+            y = (y << width) | ((b >> (6 - 2 * width)) & mask)
+        sign = 1 << (width * len(value) - 1)
+        x = (x ^ sign) - sign
+        y = (y ^ sign) - sign
+        return x / sign, y / sign
+
+    def _coords(self, operands):
+        return [self._coord(v) for v in self._values(operands,
+                                                     self.multi_len)]
+
+    def _color(self, operands):
+        # Two bits each of green, red and blue per byte, most significant
+        # first
+        r = g = b = 0
+        for byte in operands:
+            g = (g << 1) | ((byte >> 5) & 1)
+            r = (r << 1) | ((byte >> 4) & 1)
+            b = (b << 1) | ((byte >> 3) & 1)
+            g = (g << 1) | ((byte >> 2) & 1)
+            r = (r << 1) | ((byte >> 1) & 1)
+            b = (b << 1) | (byte & 1)
+        bits = 2 * len(operands)
+        if not bits:
+            return self.color
+        scale = 255 / ((1 << bits) - 1)
+        return int(r * scale), int(g * scale), int(b * scale)
+
+    ### drawing helpers
+
+    def _to_pixel(self, point):
+        raster = self.raster
+        # Keep wild coordinates from turning into very long lines
+        x = min(max(point[0], -1.0), 2.0)
+        y = min(max(point[1], -1.0), 2.0)
+        return (int(x * raster.width),
+                raster.height - 1 - int(y * raster.width))
+
+    def _advance(self, columns, rows):
+        w, h = self.char_size
+        self.pos = (self.pos[0] + columns * w, self.pos[1] - rows * h)
+
+    def _polygon(self, points, filled):
+        pixels = [self._to_pixel(p) for p in points]
+        if filled:
+            self.raster.fill_polygon(pixels, self.color)
+        else:
+            self.raster.polyline(pixels, self.color, closed=True)
+
+    def _arc(self, points, filled):
+        # Three points define a circle; draw from the first to the last
+        # through the middle.
+        if len(points) < 3:
+            self.raster.polyline([self._to_pixel(p) for p in points],
+                                 self.color)
+            return
+        (x1, y1), (x2, y2), (x3, y3) = points[:3]
+        d = 2 * (x1 * (y2 - y3) + x2 * (y3 - y1) + x3 * (y1 - y2))
+        if not d:
+            self.raster.polyline([self._to_pixel(p) for p in points[:3]],
+                                 self.color)
+            return
+        ux = ((x1 * x1 + y1 * y1) * (y2 - y3) +
+              (x2 * x2 + y2 * y2) * (y3 - y1) +
+              (x3 * x3 + y3 * y3) * (y1 - y2)) / d
+        uy = ((x1 * x1 + y1 * y1) * (x3 - x2) +
+              (x2 * x2 + y2 * y2) * (x1 - x3) +
+              (x3 * x3 + y3 * y3) * (x2 - x1)) / d
+        r = math.hypot(x1 - ux, y1 - uy)
+        a1 = math.atan2(y1 - uy, x1 - ux)
+        a2 = math.atan2(y2 - uy, x2 - ux)
+        a3 = math.atan2(y3 - uy, x3 - ux)
+        # Go whichever way passes through the middle point
+        span = (a3 - a1) % (2 * math.pi)
+        if (a2 - a1) % (2 * math.pi) > span:
+            span -= 2 * math.pi
+        if points[0] == points[2]:
+            span = 2 * math.pi
+        steps = max(8, int(abs(span) * r * self.raster.width / 2))
+        steps = min(steps, 720)
+        arc = [(ux + r * math.cos(a1 + span * i / steps),
+                uy + r * math.sin(a1 + span * i / steps))
+               for i in range(steps + 1)]
+        if filled:
+            self._polygon(arc, True)
+        else:
+            self.raster.polyline([self._to_pixel(p) for p in arc],
+                                 self.color)
+
+    ### dispatchers
+
+    def _control(self, code):
+        if code == APB:
+            self._advance(-1, 0)
+        elif code == APF:
+            self._advance(1, 0)
+        elif code == APD:
+            self._advance(0, 1)
+        elif code == APU:
+            self._advance(0, -1)
+        elif code == APR:
+            self.pos = (0.0, self.pos[1])
+        elif code == APH:
+            self.pos = (0.0, self.raster.height / self.raster.width -
+                        self.char_size[1])
+        elif code == CS:
+            self.raster.clear(self.background)
+
+    def _mosaic(self, code):
+        # 2x3 block mosaics. Bits 0-5 (skipping 0x20) light up the cells
+        # left to right, top to bottom.
+        if not (0x20 <= code < 0x40 or 0x60 <= code < 0x80):
+            self._advance(1, 0)
+            return
+        bits = (code & 0x1f) | ((code & 0x40) >> 1)
+        w, h = self.char_size
+        x, y = self.pos
+        for cell in range(6):
+            if bits & (1 << cell):
+                cx = x + (cell % 2) * w / 2
+                cy = y + h - (cell // 2 + 1) * h / 3
+                x0, y0 = self._to_pixel((cx, cy))
+                x1, y1 = self._to_pixel((cx + w / 2, cy + h / 3))
+                self.raster.fill_rect(x0, y0, x1 - 1, y1 + 1, self.color)
+        self._advance(1, 0)
+
+    def _pdi(self, code, operands):
+        if code == RESET:
+            # TODO: honor the individual reset bits
+            self.reset()
+            if operands and operands[0] & 0x01:
+                self.raster.clear(self.background)
+        elif code == DOMAIN:
+            if operands:
+                b = operands[0]
+                self.multi_len = (b & 0x07) + 1
+                self.single_len = ((b >> 3) & 0x03) + 1
+                self.dimensions = 3 if b & 0x20 else 2
+        elif code == TEXT:
+            coords = self._coords(operands[self.single_len * 2:])
+            if coords:
+                self.char_size = (abs(coords[0][0]) or self.char_size[0],
+                                  abs(coords[0][1]) or self.char_size[1])
+        elif code in (POINT_SET_ABS, POINT_ABS):
+            coords = self._coords(operands)
+            if coords:
+                self.pos = coords[0]
+                if code == POINT_ABS:
+                    self.raster.set_pixel(*self._to_pixel(self.pos),
+                                          color=self.color)
+        elif code in (POINT_SET_REL, POINT_REL):
+            for dx, dy in self._coords(operands):
+                self.pos = (self.pos[0] + dx, self.pos[1] + dy)
+                if code == POINT_REL:
+                    self.raster.set_pixel(*self._to_pixel(self.pos),
+                                          color=self.color)
+        elif code in (LINE_ABS, SET_LINE_ABS):
+            coords = self._coords(operands)
+            if code == SET_LINE_ABS and coords:
+                self.pos = coords.pop(0)
+            points = [self.pos] + coords
+            self.raster.polyline([self._to_pixel(p) for p in points],
+                                 self.color)
+            self.pos = points[-1]
+        elif code in (LINE_REL, SET_LINE_REL):
+            coords = self._coords(operands)
+            if code == SET_LINE_REL and coords:
+                self.pos = coords.pop(0)
+            points = [self.pos]
+            for dx, dy in coords:
+                points.append((points[-1][0] + dx, points[-1][1] + dy))
+            self.raster.polyline([self._to_pixel(p) for p in points],
+                                 self.color)
+            self.pos = points[-1]
+        elif code in (ARC_OUTLINED, ARC_FILLED, SET_ARC_OUTLINED,
+                      SET_ARC_FILLED):
+            coords = self._coords(operands)
+            if code in (SET_ARC_OUTLINED, SET_ARC_FILLED) and coords:
+                self.pos = coords.pop(0)
+            points = [self.pos]
+            for dx, dy in coords:
+                points.append((points[-1][0] + dx, points[-1][1] + dy))
+            self._arc(points, code in (ARC_FILLED, SET_ARC_FILLED))
+            self.pos = points[0]
+        elif code in (RECT_OUTLINED, RECT_FILLED, SET_RECT_OUTLINED,
+                      SET_RECT_FILLED):
+            coords = self._coords(operands)
+            if code in (SET_RECT_OUTLINED, SET_RECT_FILLED) and coords:
+                self.pos = coords.pop(0)
+            if coords:
+                (x, y), (dx, dy) = self.pos, coords[0]
+                points = [(x, y), (x + dx, y), (x + dx, y + dy), (x, y + dy)]
+                self._polygon(points, code in (RECT_FILLED, SET_RECT_FILLED))
+                # The position moves to the lower right corner
+                self.pos = (x + dx, y)
+        elif code in (POLY_OUTLINED, POLY_FILLED, SET_POLY_OUTLINED,
+                      SET_POLY_FILLED):
+            coords = self._coords(operands)
+            if code in (SET_POLY_OUTLINED, SET_POLY_FILLED) and coords:
+                self.pos = coords.pop(0)
+            points = [self.pos]
+            for dx, dy in coords:
+                points.append((points[-1][0] + dx, points[-1][1] + dy))
+            self._polygon(points, code in (POLY_FILLED, SET_POLY_FILLED))
+        elif code == FIELD:
+            coords = self._coords(operands)
+            if coords:
+                self.pos = coords[0]
+                self.field = coords[:2]
+        elif code == SET_COLOR:
+            self.color = self._color(operands)
+        elif code == SELECT_COLOR:
+            if operands:
+                self.color = self.palette[operands[0] & 0x0f]
+        # TEXTURE, WAIT, BLINK and the INCREMENTAL instructions are ignored
+
+
+def render(data, filename=None, width=512, height=384, timeout=None,
+           force=True):
+    """Render a NAPLPS payload and optionally save it
+
+    The file format (PNG or PPM) is chosen from filename's extension.
+    Returns the Raster.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    raster = Renderer(Raster(width, height)).render(data, deadline)
+    if filename is not None:
+        raster.save(filename, force)
+    return raster
+
+
+# render_job statuses
+RENDERED = 'rendered'
+FAILED = 'failed'
+TIMED_OUT = 'timed out'
+
+
+def render_job(job):
+    """Process pool friendly wrapper around render()
+
+    job is a (filename, data, width, height, timeout, force) tuple. Returns
+    (filename, status, message) where status is RENDERED, FAILED or
+    TIMED_OUT and message is None on success.
+    """
+    filename, data, width, height, timeout, force = job
+    try:
+        render(data, filename, width, height, timeout, force)
+    except RenderTimeout as e:
+        return filename, TIMED_OUT, str(e.value)
+    except Exception as e:
+        return filename, FAILED, '{}: {}'.format(e.__class__.__name__, e)
+    return filename, RENDERED, None
+
+
+class NAPLPSException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class RenderTimeout(NAPLPSException):
+    pass
@@ -15,19 +15,25 @@ class Reader:
             self.fd = data
             self.mmap = mmap.mmap(self.fd, length, access=access,
                                   offset=offset)
-        elif isinstance(data, bytes):
+        elif isinstance(data, (bytes, bytearray, memoryview)):
+            # An anonymous map can't be empty
+            if not (length or data):
+                raise EOFError('no data to read')
             self.fd = False
             self.mmap = mmap.mmap(-1, length or len(data), access=access,
                                   offset=offset)
             # Write the data to the anonymous map
             self.write(data)
             self.seek(0)
-        elif isinstance(data, mmap.mmap):
+        elif all(hasattr(data, attr)
+                 for attr in ('read', 'seek', 'tell', '__getitem__')):
+            # An mmap or anything that works like one, e.g. a
+            # compressed.CompressedFile
             self.fd = True
             self.mmap = data
         else:
             raise TypeError('first arg must be a file object, a file '
-                            'descriptor, or bytes')
+                            'descriptor, a map, or bytes (or a buffer)')
         self.set_little_endian(little_endian)
 
     def __enter__(self):
@@ -0,0 +1,164 @@
+
+import bisect
+import copy
+
+from prodigyclassic.stage import structures
+
+
+class ExtentAllocator:
+    """Free space of an AUM kept as sorted runs (extents)
+
+    Runs are indexed both by where they start and by their length, so
+    finding the best fit, allocating and freeing (with coalescing) are
+    binary searches rather than scans of the table. The table is kept up to
+    date as chains are handed out and given back.
+
+    The indexes are plain sorted lists, so adding or removing a run is a
+    memmove of O(runs). That's cheap next to building one, which goes
+    through the whole table, so a StageFile keeps its allocator between
+    updates.
+    """
+
+    def __init__(self, aum, first=None, end=None):
+        self.aum = aum
+        self.first = aum.startid if first is None else first
+        self.end = len(aum.table) if end is None else min(end,
+                                                          len(aum.table))
+        self.free_count = 0
+
+        self._starts = []   # sorted run starts
+        self._lengths = {}  # run start -> length
+        self._sizes = []    # sorted (length, start)
+
+        for kind, start, count in aum.get_runs():
+            if kind is not aum.FreeRun:
+                continue
+            start, stop = max(start, self.first), min(start + count,
+                                                      self.end)
+            if start < stop:
+                self._add(start, stop - start)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def copy(self, aum=None):
+        """Return a copy, working on aum's table if given
+
+        aum must have the same free AUs as this allocator's.
+        """
+        new = copy.copy(self)
+        if aum is not None:
+            new.aum = aum
+        new._starts = list(self._starts)
+        new._lengths = dict(self._lengths)
+        new._sizes = list(self._sizes)
+        return new
+
+    def get_extents(self):
+        """Return the free runs as (start, length) in AU order"""
+        return [(start, self._lengths[start]) for start in self._starts]
+
+    def _add(self, start, length):
+        bisect.insort(self._starts, start)
+        self._lengths[start] = length
+        bisect.insort(self._sizes, (length, start))
+        self.free_count += length
+
+    def _remove(self, start):
+        length = self._lengths.pop(start)
+        del self._starts[bisect.bisect_left(self._starts, start)]
+        del self._sizes[bisect.bisect_left(self._sizes, (length, start))]
+        self.free_count -= length
+        return length
+
+    def allocate_extent(self, count):
+        """Take count contiguous AUs from the smallest run that fits
+
+        Returns the first AUid or None if no run is long enough. The table
+        isn't touched.
+        """
+        i = bisect.bisect_left(self._sizes, (count, -1))
+        if i == len(self._sizes):
+            return None
+        length, start = self._sizes[i]
+        self._remove(start)
+        if length > count:
+            self._add(start + count, length - count)
+        return start
+
+    def allocate(self, count):
+        """Allocate a chain of count AUs and link it in the table
+
+        The chain is contiguous whenever a run is long enough. Otherwise
+        it's made from as few (of the largest) runs as possible, in AU
+        order.
+        """
+        count = max(count, 1)
+        if count > self.free_count:
+            raise NoSpaceError('{} AUs needed but only {} are free'
+                               .format(count, self.free_count))
+
+        start = self.allocate_extent(count)
+        if start is not None:
+            pieces = [(start, count)]
+        else:
+            pieces = []
+            needed = count
+            while needed:
+                length, start = self._sizes[-1]
+                if length > needed:
+                    # Best fit for what's left
+                    take = needed
+                    start = self.allocate_extent(take)
+                else:
+                    take = length
+                    self._remove(start)
+                pieces.append((start, take))
+                needed -= take
+            pieces.sort()
+
+        chain = []
+        for start, length in pieces:
+            chain.extend(range(start, start + length))
+        table = self.aum.table
+        for AUid, next_AUid in zip(chain, chain[1:]):
+            table[AUid] = next_AUid
+        table[chain[-1]] = self.aum.EolEntryValue
+        return chain
+
+    def free(self, chain):
+        """Mark the AUs of a chain free and merge them with their
+        neighbors"""
+        table = self.aum.table
+        # Anything already free is left alone
+        AUids = sorted(AUid for AUid in set(chain)
+                       if table[AUid] != self.aum.FreeEntryValue)
+        for AUid in AUids:
+            table[AUid] = self.aum.FreeEntryValue
+
+        # Turn the AUs into runs and add them one at a time
+        AUids = [AUid for AUid in AUids if self.first <= AUid < self.end]
+        runs = []
+        for AUid in AUids:
+            if runs and runs[-1][0] + runs[-1][1] == AUid:
+                runs[-1][1] += 1
+            else:
+                runs.append([AUid, 1])
+
+        for start, length in runs:
+            i = bisect.bisect_left(self._starts, start)
+            # Merge with the run before?
+            if i > 0:
+                prev = self._starts[i - 1]
+                if prev + self._lengths[prev] == start:
+                    length += self._remove(prev)
+                    start = prev
+            # And the one after?
+            nxt = start + length
+            if nxt in self._lengths:
+                length += self._remove(nxt)
+            self._add(start, length)
+
+
+class NoSpaceError(structures.StructureException):
+    pass
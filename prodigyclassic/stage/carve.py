@@ -0,0 +1,221 @@
+
+import mmap
+import multiprocessing
+
+from prodigyclassic.stage import segments, structures
+
+
+def looks_like_header(data):
+    """Quick test of whether 18 bytes could be an object header"""
+    if len(data) < structures.Object._format.size:
+        return False
+    name = data[:11].rstrip(b' ')
+    # Printable ASCII and not starting with a space
+    if not name or name[0] == 0x20:
+        return False
+    if any(not 0x20 <= c <= 0x7e for c in name):
+        return False
+    length = data[13] | (data[14] << 8)
+    return length > structures.Object._format.size
+
+
+def validate(data):
+    """Return the Object if data parses cleanly, otherwise None"""
+    obj = structures.Object()
+    factory = segments.SegmentFactory()
+    try:
+        obj.unpack(data)
+        found = False
+        for segment in factory.parse_segments(obj):
+            if segment.get_exceptions():
+                return None
+            found = True
+    except structures.StructureException:
+        return None
+    return found and obj or None
+
+
+class Found:
+    """An object found by the carver"""
+
+    # How the chain was worked out
+    FromAUM = 'aum{}'
+    Contiguous = 'contiguous'
+    SkipOwned = 'skip-owned'
+
+    def __init__(self, AUid, id_, length, version, method=None, chain=None):
+        self.AUid = AUid
+        self.id = id_
+        self.length = length
+        self.version = version
+        self.method = method
+        self.chain = chain
+
+
+# Set up in each worker by _init()
+_worker = {}
+
+
+def _init(filename, geometry, tables):
+    f = open(filename, 'rb')
+    _worker['file'] = f
+    _worker['map'] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _worker['geometry'] = geometry
+    _worker['tables'] = tables
+
+
+def _read_chain(stage_map, geometry, chain, length):
+    auq, austartoffset, startid = geometry
+    data = []
+    for AUid in chain:
+        offset = austartoffset + (AUid - startid) * auq
+        data.append(stage_map[offset:offset + auq])
+    return b''.join(data)[:length]
+
+
+def scan(job):
+    """Look for objects starting in AUs first to stop
+
+    Each candidate is tried with a chain from every map, then as a
+    contiguous run. Returns a list of Found; method is None for candidates
+    that couldn't be resolved.
+    """
+    first, stop = job
+    stage_map = _worker['map']
+    auq, austartoffset, startid = geometry = _worker['geometry']
+    tables = _worker['tables']
+    end = startid + (len(stage_map) - austartoffset) // auq
+
+    found = []
+    for AUid in range(first, stop):
+        offset = austartoffset + (AUid - startid) * auq
+        header = stage_map[offset:offset + structures.Object._format.size]
+        if not looks_like_header(header):
+            continue
+        id_ = structures.ObjectID()
+        id_.unpack(header[:13])
+        length = header[13] | (header[14] << 8)
+        version = structures.VersionID(header[17], header[15])
+        candidate = Found(AUid, id_, length, version)
+        needed = -(-length // auq)
+
+        chains = []
+        for index, table in enumerate(tables):
+            if table is None:
+                continue
+            # Only as far as the object needs; the map may be garbage
+            chain = [AUid]
+            while len(chain) < needed:
+                AUid_next = table[chain[-1]]
+                if not startid <= AUid_next < len(table):
+                    break
+                chain.append(AUid_next)
+            if len(chain) == needed:
+                chains.append((Found.FromAUM.format(index), chain))
+        if AUid + needed <= end:
+            chains.append((Found.Contiguous,
+                           list(range(AUid, AUid + needed))))
+
+        for method, chain in chains:
+            if validate(_read_chain(stage_map, geometry, chain, length)):
+                candidate.method = method
+                candidate.chain = chain
+                break
+        found.append(candidate)
+    return found
+
+
+class Carver:
+    """Recover objects from an image without using its directory
+
+    geometry is (auquantasize, austartoffset, prologuestartid). tables are
+    AUM tables that may still be good; they're only used as hints.
+    """
+
+    def __init__(self, filename, geometry, tables=(), processes=None,
+                 chunk=1 << 14):
+        self.filename = filename
+        self.geometry = geometry
+        self.tables = list(tables)
+        self.processes = processes
+        self.chunk = chunk
+        self._file = self._map = None
+
+    def carve(self, first=None, stop=None):
+        """Scan the AUs and return everything found in AU order"""
+        auq, austartoffset, startid = self.geometry
+        with open(self.filename, 'rb') as f:
+            size = f.seek(0, 2)
+        end = startid + max(size - austartoffset, 0) // auq
+        first = startid if first is None else max(first, startid)
+        stop = end if stop is None else min(stop, end)
+        jobs = [(start, min(start + self.chunk, stop))
+                for start in range(first, stop, self.chunk)]
+
+        args = (self.filename, self.geometry, self.tables)
+        if self.processes == 1:
+            _init(*args)
+            results = [scan(job) for job in jobs]
+        else:
+            with multiprocessing.Pool(self.processes, _init, args) as pool:
+                results = pool.map(scan, jobs)
+        found = [candidate for result in results for candidate in result]
+        return self.rebuild(found)
+
+    def rebuild(self, found):
+        """Second try at the candidates the workers couldn't resolve
+
+        The AUs of every resolved object are taken out and the unresolved
+        ones are tried as the next free AUs, i.e. assuming whatever was
+        written in between belongs to someone else. Unresolved candidates
+        inside a resolved object are just its data and are dropped.
+
+        Returns what's left of found.
+        """
+        auq = self.geometry[0]
+        owned = set()
+        for candidate in found:
+            if candidate.chain:
+                owned.update(candidate.chain)
+        found = [candidate for candidate in found
+                 if candidate.method or candidate.AUid not in owned]
+
+        with open(self.filename, 'rb') as f:
+            stage_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            end = (self.geometry[2] +
+                   (len(stage_map) - self.geometry[1]) // auq)
+            for candidate in found:
+                if candidate.method:
+                    continue
+                needed = -(-candidate.length // auq)
+                chain = []
+                AUid = candidate.AUid
+                while len(chain) < needed and AUid < end:
+                    if AUid not in owned:
+                        chain.append(AUid)
+                    AUid += 1
+                if len(chain) < needed:
+                    continue
+                data = _read_chain(stage_map, self.geometry, chain,
+                                   candidate.length)
+                if validate(data):
+                    candidate.method = Found.SkipOwned
+                    candidate.chain = chain
+                    owned.update(chain)
+            stage_map.close()
+        return found
+
+    def read(self, candidate):
+        """Return the data of a resolved candidate"""
+        if self._map is None:
+            self._file = open(self.filename, 'rb')
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        return _read_chain(self._map, self.geometry, candidate.chain,
+                           candidate.length)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._file = self._map = None
@@ -0,0 +1,99 @@
+
+import difflib
+
+from prodigyclassic.stage import segments
+
+
+# Kinds of difference
+Added = '+'
+Removed = '-'
+Changed = 'M'
+# Directory entry differs but the contents are the same
+Touched = 'T'
+Same = '='
+
+
+def entry_key(entry):
+    return (entry.id.name, entry.id.location, entry.id.type)
+
+
+def same_metadata(entry_a, entry_b):
+    return (entry_a.length == entry_b.length and
+            entry_a.check == entry_b.check and
+            (entry_a.version.byte1, entry_a.version.byte2) ==
+            (entry_b.version.byte1, entry_b.version.byte2))
+
+
+def compare(stage_a, dir_a, stage_b, dir_b, verify=False, index_a=None,
+            index_b=None):
+    """Compare two directories object by object
+
+    Objects with the same length, version and check are taken to be the
+    same without reading them (unless verify). Otherwise the contents are
+    compared. Yields (kind, entry_a, entry_b) in name order; entries are
+    None when missing from one side. index_a and index_b are the
+    generations to read objects from (default: the current ones).
+    """
+    entries_a = {entry_key(entry): entry
+                 for entry in dir_a.entrylist[:dir_a.inuse]}
+    entries_b = {entry_key(entry): entry
+                 for entry in dir_b.entrylist[:dir_b.inuse]}
+
+    for key in sorted(entries_a.keys() | entries_b.keys(),
+                      key=lambda k: (k[0] or b'', k[1], k[2])):
+        entry_a = entries_a.get(key)
+        entry_b = entries_b.get(key)
+        if entry_b is None:
+            yield Removed, entry_a, None
+        elif entry_a is None:
+            yield Added, None, entry_b
+        elif entry_a.length != entry_b.length:
+            yield Changed, entry_a, entry_b
+        elif same_metadata(entry_a, entry_b) and not verify:
+            yield Same, entry_a, entry_b
+        elif (read_object(stage_a, entry_a, index_a) ==
+                read_object(stage_b, entry_b, index_b)):
+            yield (Same if same_metadata(entry_a, entry_b) else Touched,
+                   entry_a, entry_b)
+        else:
+            yield Changed, entry_a, entry_b
+
+
+def read_object(stage, entry, index=None):
+    """Read an object's data (with header) straight from its chain"""
+    aum = stage.AUM if index is None else stage.AUMaps[index]
+    return stage.read_chain(aum.get_chain(entry.startid))[:entry.length]
+
+
+def segment_diff(obj_a, obj_b):
+    """Diff the segments of two versions of an object
+
+    Yields (kind, segment_a, segment_b). Replaced segments of the same type
+    are paired up as Changed.
+    """
+    factory = segments.SegmentFactory()
+    segments_a = list(factory.parse_segments(obj_a))
+    segments_b = list(factory.parse_segments(obj_b))
+    keys_a = [(s.get_seg_type(), bytes(s.get_data(True))) for s in segments_a]
+    keys_b = [(s.get_seg_type(), bytes(s.get_data(True))) for s in segments_b]
+
+    matcher = difflib.SequenceMatcher(None, keys_a, keys_b, autojunk=False)
+    for op, a1, a2, b1, b2 in matcher.get_opcodes():
+        if op == 'equal':
+            continue
+        old = segments_a[a1:a2]
+        i = 0
+        for segment in segments_b[b1:b2]:
+            # The next old segment of the same type is the one that changed
+            for j in range(i, len(old)):
+                if old[j].get_seg_type() == segment.get_seg_type():
+                    break
+            else:
+                yield Added, None, segment
+                continue
+            for removed in old[i:j]:
+                yield Removed, removed, None
+            yield Changed, old[j], segment
+            i = j + 1
+        for removed in old[i:]:
+            yield Removed, removed, None
@@ -0,0 +1,314 @@
+
+import collections
+import multiprocessing
+
+from prodigyclassic.stage import segments, stagefile, structures
+
+
+# Problem severities
+ERROR = 'error'
+WARNING = 'warning'
+
+
+def problem(severity, kind, message, generation=None, **details):
+    """Problems are plain dicts so they're easy to pass around and dump"""
+    p = {'severity': severity, 'kind': kind, 'message': message}
+    if generation is not None:
+        p['generation'] = generation
+    p.update(details)
+    return p
+
+
+def walk_chain(table, AUid, limit=None, first=0, end=None):
+    """Follow a chain without trusting the table
+
+    Returns (chain, error) where error is None if the chain ended properly.
+    Only AUs from first up to end (the ones that can be read) go in the
+    chain. A chain can't be longer than the table so that's the limit;
+    anything longer has a loop.
+    """
+    if limit is None:
+        limit = len(table)
+    if end is None:
+        end = len(table)
+    chain = []
+    while True:
+        if not 0 <= AUid < len(table):
+            return chain, 'AU {} does not exist'.format(AUid)
+        if AUid < first:
+            return chain, 'AU {} is before the first AU ({})'.format(AUid,
+                                                                     first)
+        if AUid >= end:
+            return chain, 'AU {} is past the end of the file'.format(AUid)
+        chain.append(AUid)
+        n = table[AUid]
+        if n == structures.AUM.EolEntryValue:
+            return chain, None
+        if n == structures.AUM.FreeEntryValue:
+            return chain, 'AU {} is not allocated'.format(AUid)
+        if len(chain) >= limit:
+            return chain, 'chain loops'
+        AUid = n
+
+
+class Checker:
+    """Check the consistency of both generations of a STAGE.DAT
+
+    Structural checks (prologue, Check stamps, AU ownership) are done here.
+    The per-object checks (directory entry against object header, segment
+    parsing) are spread over a process pool when a filename is given.
+    """
+
+    def __init__(self, stage, filename=None, processes=None):
+        self.stage = stage
+        self.filename = filename
+        self.processes = processes
+        self.problems = []
+
+    def add(self, *args, **kwargs):
+        self.problems.append(problem(*args, **kwargs))
+
+    def run(self):
+        if self.check_prologue():
+            for index in (0, 1):
+                self.check_generation(index)
+            self.check_objects()
+        return self.problems
+
+    def check_prologue(self):
+        stage = self.stage
+        prologue = stage.prologue
+        ok = True
+        if not prologue.auquantasize:
+            self.add(ERROR, 'prologue', 'auquantasize is 0')
+            ok = False
+        if not 1 <= prologue.mapwidth <= 16:
+            self.add(ERROR, 'prologue', 'mapwidth of {} is not supported'
+                     .format(prologue.mapwidth))
+            ok = False
+        if prologue.curstartidx not in (0, 1):
+            self.add(ERROR, 'prologue', 'curstartidx is {}'
+                     .format(prologue.curstartidx))
+            ok = False
+        if prologue.prologuestartid <= structures.AUM.EolEntryValue:
+            self.add(ERROR, 'prologue', 'prologuestartid is {}'
+                     .format(prologue.prologuestartid))
+            ok = False
+        if prologue.maxmapentries > 1 << prologue.mapwidth:
+            self.add(ERROR, 'prologue', '{} map entries do not fit in {} '
+                     'bits'.format(prologue.maxmapentries,
+                                   prologue.mapwidth))
+        if not ok:
+            return False
+
+        # Everything the maps say exists should be in the file
+        end = stage.offset_to_AUid(len(stage.stage_map))
+        if end < prologue.maxmapentries:
+            self.add(WARNING, 'prologue', 'file only holds AUs up to {:#x} '
+                     'of {:#x}'.format(end, prologue.maxmapentries),
+                     end=end)
+        # TODO: check RS source for what Prologue.check covers
+        return True
+
+    def check_generation(self, index):
+        stage = self.stage
+        prologue = stage.prologue
+        aum = stage.AUMaps[index]
+        directory = stage.dirs[index]
+        table = aum.table
+
+        # The map and directory of a generation are tied together with the
+        # same Check values
+        if (aum.checks.mapcheck != directory.checks.mapcheck or
+                aum.checks.dircheck != directory.checks.dircheck):
+            self.add(ERROR, 'check', 'AUM {!r} does not match directory '
+                     '{!r}'.format(aum.checks, directory.checks), index)
+
+        if directory.inuse > directory.maximum:
+            self.add(ERROR, 'directory', 'inuse ({}) > maximum ({})'
+                     .format(directory.inuse, directory.maximum), index)
+
+        # Reverse ownership: who does every AU belong to? -1 is nobody.
+        owners = [-1] * len(table)
+        names = ['P', 'M0', 'M1', 'D0', 'D1']
+
+        # (first owner, second owner) -> shared AUs
+        crossed = collections.defaultdict(list)
+
+        def claim(owner, chain):
+            for AUid in chain:
+                if owners[AUid] == -1:
+                    owners[AUid] = owner
+                elif owners[AUid] != owner:
+                    crossed[owners[AUid], owner].append(AUid)
+
+        def name(owner):
+            if owner < len(names):
+                return names[owner]
+            entry = directory.entrylist[owner - len(names)]
+            return '{} ({})'.format(entry.id.get_name(True, True),
+                                    owner - len(names))
+
+        first_AU, end_AU = AU_bounds(stage)
+
+        def claim_chain(owner, AUid):
+            chain, error = walk_chain(table, AUid, first=first_AU,
+                                      end=end_AU)
+            if error:
+                self.add(ERROR, 'chain', '{}: {}'.format(name(owner), error),
+                         index, au=AUid)
+            claim(owner, chain)
+            return chain
+
+        if prologue.austartoffset < prologue.size:
+            claim_chain(0, prologue.prologuestartid)
+        map_AUs = -(-aum.size // prologue.auquantasize)
+        for i, startid in enumerate(prologue.startids):
+            first = startid.mapstartid
+            if first + map_AUs > len(table):
+                self.add(ERROR, 'map', 'map {} runs past the end of the '
+                         'table'.format(i), index)
+            claim(1 + i, range(first, min(first + map_AUs, len(table))))
+            claim_chain(3 + i, startid.dirstartid)
+
+        seen = {}
+        auq = prologue.auquantasize
+        for obj_idx in range(min(directory.inuse, directory.maximum)):
+            entry = directory.entrylist[obj_idx]
+            if entry.id.name in seen:
+                self.add(ERROR, 'directory', '{} is in the directory twice '
+                         '({} and {})'.format(entry.id.get_name(True, True),
+                                              seen[entry.id.name], obj_idx),
+                         index, object=obj_idx)
+            seen[entry.id.name] = obj_idx
+            if obj_idx and (directory.entrylist[obj_idx - 1].id.name or b'') \
+                    > (entry.id.name or b''):
+                self.add(WARNING, 'directory', '{} is out of order'
+                         .format(entry.id.get_name(True, True)), index,
+                         object=obj_idx)
+
+            chain = claim_chain(len(names) + obj_idx, entry.startid)
+            needed = -(-entry.length // auq)
+            if len(chain) < needed:
+                self.add(ERROR, 'length', '{}: length {} needs {} AUs but '
+                         'the chain has {}'
+                         .format(name(len(names) + obj_idx), entry.length,
+                                 needed, len(chain)),
+                         index, object=obj_idx)
+            elif len(chain) > needed:
+                self.add(WARNING, 'length', '{}: chain has {} AUs, only {} '
+                         'needed'.format(name(len(names) + obj_idx),
+                                         len(chain), needed),
+                         index, object=obj_idx)
+
+        for (first, second), AUids in crossed.items():
+            self.add(ERROR, 'cross-link', '{} and {} share {} AUs from {:#x}'
+                     .format(name(first), name(second), len(AUids),
+                             AUids[0]),
+                     index, aus=AUids)
+
+        # Allocated but owned by nobody
+        leaked = [AUid for AUid in range(prologue.prologuestartid,
+                                         len(table))
+                  if owners[AUid] == -1 and
+                  table[AUid] != structures.AUM.FreeEntryValue]
+        if leaked:
+            self.add(WARNING, 'leak', '{} AUs are allocated but not '
+                     'reachable'.format(len(leaked)), index, aus=leaked)
+
+    def check_objects(self):
+        jobs = []
+        for index in (0, 1):
+            directory = self.stage.dirs[index]
+            count = min(directory.inuse, directory.maximum)
+            step = max(count // ((self.processes or
+                                  multiprocessing.cpu_count()) * 4), 64)
+            jobs.extend((self.filename, index, start,
+                         min(start + step, count))
+                        for start in range(0, count, step))
+
+        if self.filename is None or self.processes == 1:
+            results = [check_objects(job, self.stage) for job in jobs]
+        else:
+            with multiprocessing.Pool(self.processes) as pool:
+                results = pool.map(check_objects, jobs)
+        for result in results:
+            self.problems.extend(result)
+
+
+def AU_bounds(stage):
+    """Return (first, end), the AUids that can be read from the file"""
+    return (stage.prologue.prologuestartid,
+            stage.offset_to_AUid(len(stage.stage_map)))
+
+
+def check_objects(job, stage=None):
+    """Check a range of objects against their directory entries
+
+    job is (filename, generation, start, stop). The file is opened here
+    when no StageFile is given so this can run in another process.
+    """
+    filename, index, start, stop = job
+    f = None
+    if stage is None:
+        f = open(filename, 'rb')
+        stage = stagefile.StageFile(stagefile.map_file(f))
+        stage.load()
+
+    problems = []
+    factory = segments.SegmentFactory()
+    aum = stage.AUMaps[index]
+    directory = stage.dirs[index]
+    first, end = AU_bounds(stage)
+    for obj_idx in range(start, stop):
+        entry = directory.entrylist[obj_idx]
+        label = '{} ({})'.format(entry.id.get_name(True, True), obj_idx)
+        chain, error = walk_chain(aum.table, entry.startid, first=first,
+                                  end=end)
+        if error:
+            # Already reported by check_generation
+            continue
+        data = stage.read_chain(chain)[:entry.length]
+        obj = structures.Object()
+        try:
+            obj.unpack(data)
+        except structures.StructureException as e:
+            problems.append(problem(ERROR, 'object', '{}: {}'
+                                    .format(label, e), index,
+                                    object=obj_idx))
+            continue
+
+        if (obj.id.name != entry.id.name or
+                obj.id.location != entry.id.location or
+                obj.id.type != entry.id.type):
+            problems.append(problem(ERROR, 'object', '{}: header says {}'
+                                    .format(label, obj.id.get_id(True,
+                                                                 True)),
+                                    index, object=obj_idx))
+        if obj.length != entry.length:
+            problems.append(problem(ERROR, 'object', '{}: header length is {}'
+                                    .format(label, obj.length),
+                                    index, object=obj_idx))
+        if (obj.version.byte1, obj.version.byte2) != (entry.version.byte1,
+                                                      entry.version.byte2):
+            problems.append(problem(WARNING, 'object', '{}: header version '
+                                    'is {!r}'.format(label, obj.version),
+                                    index, object=obj_idx))
+
+        # Make sure the segments (including imbedded objects') parse
+        pending = [obj]
+        while pending:
+            for segment in factory.parse_segments(pending.pop()):
+                for exception in segment.get_exceptions():
+                    problems.append(problem(
+                        WARNING, 'segment', '{}: {}: {}'
+                        .format(label, segment.__class__.__name__,
+                                exception),
+                        index, object=obj_idx))
+                if isinstance(segment, segments.ImbeddedObjectSegment):
+                    pending.append(segment.object)
+
+    if f is not None:
+        stage.stage_map.close()
+        f.close()
+    return problems
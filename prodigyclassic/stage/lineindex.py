@@ -0,0 +1,90 @@
+
+import bisect
+import json
+import os
+
+
+def default_filename(stage_filename):
+    return stage_filename + '.lines'
+
+
+def image_key(stage, stage_fd):
+    """What an index has to match to be used with an image
+
+    The file's size and modification time plus the current generation's
+    checks and object count.
+    """
+    st = os.fstat(stage_fd.fileno())
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+            'index': stage.prologue.curstartidx,
+            'mapcheck': stage.AUM.checks.mapcheck,
+            'dircheck': stage.dir.checks.dircheck,
+            'inuse': stage.dir.inuse}
+
+
+class LineIndex:
+    """Where each object's lines are in dir/view/extract numbering
+
+    dir, view and extract number an object, then each of its segments, and
+    an imbedded object gets a line of its own after its segment. For each
+    directory entry the index keeps the number of lines it takes and its
+    number of (top level) segments. The second is all that's needed to
+    number lines when imbedded objects are skipped.
+    """
+
+    version = 1
+
+    def __init__(self, key=None):
+        self.key = key
+        self.lines = []
+        self.segments = []
+
+    def add(self, lines, segments):
+        self.lines.append(lines)
+        self.segments.append(segments)
+
+    def first_lines(self, skip_imbedded=False):
+        """Return the line number of each object"""
+        sizes = ([count + 1 for count in self.segments] if skip_imbedded
+                 else self.lines)
+        firsts = []
+        line = 1
+        for size in sizes:
+            firsts.append(line)
+            line += size
+        return firsts
+
+    def find(self, line_numbers, skip_imbedded=False):
+        """Return {directory index: its first line} for the objects holding
+        line_numbers"""
+        firsts = self.first_lines(skip_imbedded)
+        found = {}
+        for line in line_numbers:
+            obj_idx = bisect.bisect_right(firsts, line) - 1
+            if obj_idx >= 0:
+                found[obj_idx] = firsts[obj_idx]
+        return found
+
+    def save(self, filename):
+        temp = filename + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'version': self.version, 'key': self.key,
+                       'lines': self.lines, 'segments': self.segments}, f,
+                      separators=(',', ':'))
+        os.replace(temp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Return the index saved in filename, or None if there isn't a
+        usable one"""
+        try:
+            with open(filename) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if saved.get('version') != cls.version:
+            return None
+        index = cls(saved['key'])
+        index.lines = saved['lines']
+        index.segments = saved['segments']
+        return index
@@ -0,0 +1,123 @@
+
+import bisect
+import multiprocessing
+import re
+import struct
+
+from prodigyclassic.stage import segments, stagefile, structures
+
+
+_segment_hdr = struct.Struct('<BH')
+_object_hdr_size = structures.Object._format.size
+
+
+def compile_patterns(patterns):
+    """Build one regular expression finding any of patterns (bytes)
+
+    Matches may overlap. Longer patterns win when several start at the same
+    place.
+    """
+    patterns = sorted(set(patterns), key=len, reverse=True)
+    return re.compile(b'(?=(' + b'|'.join(re.escape(p) for p in patterns) +
+                      b'))', re.DOTALL)
+
+
+def segment_spans(data, start=_object_hdr_size):
+    """Return (starts, segments) for the segments of an object
+
+    segments are (start, type, length), read straight from the segment
+    headers. Nothing is decoded.
+    """
+    starts = []
+    spans = []
+    pos = start
+    while pos + _segment_hdr.size <= len(data):
+        st, sl = _segment_hdr.unpack_from(data, pos)
+        if sl < _segment_hdr.size:
+            break
+        starts.append(pos)
+        spans.append((pos, st, sl))
+        pos += sl
+    return starts, spans
+
+
+def locate(data, offset, names=()):
+    """Find where in an object an offset is
+
+    Returns (object names, segment number, segment type, offset in the
+    segment). Imbedded objects are followed; names gets each one's name.
+    The segment number and type are None in an object header.
+    """
+    obj_id = structures.ObjectID()
+    obj_id.unpack(data[:obj_id.size])
+    names = names + (obj_id.get_name(True, True),)
+    if offset < _object_hdr_size:
+        return names, None, None, offset
+    starts, spans = segment_spans(data)
+    i = bisect.bisect_right(starts, offset) - 1
+    if i < 0 or offset >= spans[i][0] + spans[i][2]:
+        return names, None, None, offset
+    start, st, sl = spans[i]
+    if (st == segments.ImbeddedObjectSegment._segment_type and
+            len(names) <= segments.SegmentFactory.max_depth):
+        inner = start + _segment_hdr.size
+        if offset >= inner:
+            return locate(data[inner:start + sl], offset - inner, names)
+    return names, i, st, offset - start
+
+
+# Set up in each worker by _init()
+_worker = {}
+
+
+def _init(filename, index, regex):
+    f = open(filename, 'rb')
+    stage = stagefile.StageFile(stagefile.map_file(f))
+    stage.load()
+    stage.change_index(index)
+    _worker['stage'] = stage
+    _worker['regex'] = regex
+
+
+def search_objects(job):
+    """Search a list of directory indexes
+
+    Returns (obj_idx, offset in object, matched bytes) for every match.
+    """
+    stage = _worker['stage']
+    regex = _worker['regex']
+    found = []
+    for obj_idx in job:
+        entry = stage.dir.get_entry(obj_idx)
+        data = stage.read_chain(stage.AUM.get_chain(entry.startid))
+        data = data[:entry.length]
+        for match in regex.finditer(data):
+            found.append((obj_idx, match.start(), match.group(1)))
+    return found
+
+
+class Searcher:
+    """Search the objects of an image for any of a set of byte patterns"""
+
+    def __init__(self, filename, patterns, index=None, processes=None,
+                 chunk=64):
+        self.filename = filename
+        self.regex = compile_patterns(patterns)
+        self.index = index
+        self.processes = processes
+        self.chunk = chunk
+
+    def search(self, obj_indexes):
+        """Yield (obj_idx, offset, match) in directory order"""
+        jobs = [obj_indexes[i:i + self.chunk]
+                for i in range(0, len(obj_indexes), self.chunk)]
+        args = (self.filename, self.index, self.regex)
+        if self.processes == 1:
+            _init(*args)
+            results = map(search_objects, jobs)
+            for result in results:
+                yield from result
+        else:
+            with multiprocessing.Pool(self.processes, _init, args) as pool:
+                for result in pool.imap(search_objects, jobs):
+                    yield from result
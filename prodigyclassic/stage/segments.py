@@ -1,8 +1,7 @@
 
-import collections
 import struct
 
-from prodigyclassic import hexdump
+from prodigyclassic import hexdump, instrument
 from prodigyclassic.stage import structures
 
 
@@ -47,13 +46,15 @@ class Segment:
 
         return "\n".join(output)
 
+    # _data is usually a view of the object's data; these return copies
+
     def get_header(self):
-        return self._data[:self._segment_hdr_size]
+        return bytes(self._data[:self._segment_hdr_size])
 
     def get_data(self, with_header=False):
         if not with_header:
-            return self._data[self._segment_hdr_size:]
-        return self._data
+            return bytes(self._data[self._segment_hdr_size:])
+        return bytes(self._data)
 
     def add_exception(self, exception):
         self._exceptions.append(exception)
@@ -413,9 +414,9 @@ class ImbeddedObjectSegment(Segment):
 
     def unpack(self, data):
         super().unpack(data)
-        data = structures.Reader(data[self._segment_hdr_size:], True)
+        # Only the header is decoded; the object's data stays a view
         self.object = structures.Object()
-        self.object.unpack(data)
+        self.object.unpack(data[self._segment_hdr_size:])
 
 
 # TODO: no samples
@@ -486,68 +487,146 @@ class UnknownSegment(Segment):
         return "\n".join(output)
 
 
+class SegmentRegistry(dict):
+    """Segment classes indexed by segment type (st)
+
+    Undefined types get the unknown class. Looking one up doesn't add it.
+    """
+
+    def __init__(self, base=Segment, unknown=UnknownSegment):
+        super().__init__((cls._segment_type, cls)
+                         for cls in base.__subclasses__()
+                         if cls._segment_type)
+        self.unknown = unknown
+
+    def __missing__(self, st):
+        return self.unknown
+
+
+# Registries are built once and shared; don't change them
+_registries = {}
+
+
+def segment_registry(base=Segment, unknown=UnknownSegment):
+    registry = _registries.get((base, unknown))
+    if registry is None:
+        registry = _registries[(base, unknown)] = SegmentRegistry(base,
+                                                                  unknown)
+    return registry
+
+
 class SegmentFactory:
 
     # segment header structure
     _hdr_struct = struct.Struct('<BH')
 
-    def __init__(self, base=Segment, unknown=UnknownSegment):
-        # Create a dictionary of segment classes indexed by their type (st).
-        # Undefined segment types get a special "unknown segment" class.
-        self.segment_subclasses = collections.defaultdict(lambda: unknown,
-                {cls._segment_type: cls for cls in base.__subclasses__()
-                    if cls._segment_type})
+    # Limits on what parse_segments() will do with bad data. Past them the
+    # rest of an object (or an imbedded object) becomes an unknown segment
+    # with a SegmentLimitError.
+    max_segments = 10000
+    max_depth = 32
+
+    def __init__(self, base=Segment, unknown=UnknownSegment,
+                 max_segments=None, max_depth=None):
+        # Segment classes indexed by their type (st). Undefined segment
+        # types get a special "unknown segment" class.
+        self.segment_subclasses = segment_registry(base, unknown)
+        self.unknown = unknown
+        if max_segments is not None:
+            self.max_segments = max_segments
+        if max_depth is not None:
+            self.max_depth = max_depth
 
     def create_segment(self, id_, st, sl):
         return self.segment_subclasses[st](id_, st, sl)
 
     def parse_segments(self, obj):
-
-        with Reader(obj.data, True) as data:
-            while data.ismore():
-                loc = data.tell()
-                try:
-                    # Read in segment header
-                    st, sl = data.unpack_struct(self._hdr_struct)
-                except EOFError:
-                    # Go back and get all the data we can and put it into a
-                    # special segment
-                    segment = self.create_segment(obj.id, None, None)
-                    data.seek(loc)
-                    segment.unpack(data.read(None))
-                    segment.add_exception(
-                        SegmentDataError('invalid segment header'))
-
-                    # We're obviously done with this object
-                    yield segment
-                    break
-
-                # Create a segment object
+        instrument.count('objects_parsed')
+
+        # Segments get views of the object's data, not copies
+        data = memoryview(obj.data)
+        hdr_size = self._hdr_struct.size
+        loc = count = 0
+        while loc < len(data):
+            if loc + hdr_size > len(data):
+                # Put what's left of the data into a special segment
+                segment = self.create_segment(obj.id, None, None)
+                segment.unpack(data[loc:])
+                segment.add_exception(
+                    SegmentDataError('invalid segment header'))
+
+                # We're obviously done with this object
+                yield segment
+                break
+            st, sl = self._hdr_struct.unpack_from(data, loc)
+
+            # Every segment has to move us along or we'd never finish
+            error = None
+            if sl < hdr_size:
+                error = SegmentDataError('invalid segment length {}'
+                                         .format(sl))
+            elif count >= self.max_segments:
+                error = SegmentLimitError('more than {} segments'
+                                          .format(self.max_segments))
+            if error is not None:
+                segment = self.unknown(obj.id, st, sl)
+                segment.unpack(data[loc:])
+                segment.add_exception(error)
+                yield segment
+                break
+            count += 1
+
+            # Create a segment object. Imbedded objects nested too deep
+            # aren't decoded.
+            if (st == ImbeddedObjectSegment._segment_type and
+                    obj.depth >= self.max_depth):
+                segment = self.unknown(obj.id, st, sl)
+                segment.add_exception(SegmentLimitError(
+                    'imbedded objects nested more than {} deep'
+                    .format(self.max_depth)))
+            else:
                 segment = self.create_segment(obj.id, st, sl)
 
-                # Rewind and read in the entire segment, including the header
-                data.seek(loc)
-                try:
-                    segment_data = data.read(sl)
-                except EOFError:
-                    segment.add_exception(
-                        SegmentDataError('segment extends beyond '
-                                         'end of object'))
-
-                    # Try again, this time getting everything we can.
-                    data.seek(loc)
-                    segment_data = data.read(None)
-
-                # Process the segment's data
-                try:
+            # The entire segment, including the header (or everything we
+            # can get)
+            segment_data = data[loc:loc + sl]
+            if len(segment_data) < sl:
+                segment.add_exception(
+                    SegmentDataError('segment extends beyond '
+                                     'end of object'))
+            loc += sl
+
+            # Process the segment's data
+            try:
+                if instrument.enabled:
+                    instrument.count('segments')
+                    instrument.count('segments.' +
+                                     segment.__class__.__name__)
+                    with instrument.phase('unpack_segment'):
+                        segment.unpack(segment_data)
+                else:
                     segment.unpack(segment_data)
-                except EOFError:
-                    segment.add_exception(
-                        SegmentDataError('segment missing data'))
-                except SegmentDataError as e:
-                    segment.add_exception(e)
-
-                yield segment
+            except EOFError:
+                segment.add_exception(
+                    SegmentDataError('segment missing data'))
+            except SegmentDataError as e:
+                segment.add_exception(e)
+            except AssertionError:
+                segment.add_exception(
+                    SegmentDataError('extra data at end of segment'))
+            except structures.StructureException as e:
+                # Usually an imbedded object that doesn't unpack. Keep
+                # the bytes but don't let anyone go into it.
+                exceptions = segment.get_exceptions()
+                segment = self.unknown(obj.id, st, sl)
+                segment.unpack(segment_data)
+                segment.set_exceptions(exceptions +
+                                       [SegmentDataError(e.value)])
+
+            if isinstance(segment, ImbeddedObjectSegment):
+                segment.object.depth = obj.depth + 1
+
+            yield segment
 
 
 class SegmentException(Exception):
@@ -560,3 +639,7 @@ class SegmentException(Exception):
 
 class SegmentDataError(SegmentException):
     pass
+
+
+class SegmentLimitError(SegmentException):
+    pass
@@ -0,0 +1,477 @@
+
+"""Read-only HTTP access to STAGE.DAT images
+
+An asyncio server (plain HTTP/1.1 on top of asyncio streams) for
+browsing several images at once:
+
+    GET /                                   the images (JSON)
+    GET /IMAGE/                             IMAGE's directory (JSON)
+    GET /IMAGE/objects/OBJECT               the object's bytes
+    GET /IMAGE/objects/OBJECT/segments      its segments decoded (JSON)
+    GET /IMAGE/objects/OBJECT/hexdump       a hexdump of it (text)
+
+IMAGE is the file name without its extension and OBJECT a NAME.EXT or a
+directory index. HEAD works too. Every response carries an ETag made from
+the directory's check values (the entry's for an object) and a single
+byte range can be asked for. Decoded segments and hexdumps are kept in one
+cache shared by all the images. Large objects are decoded in a process
+pool so the event loop keeps serving.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
+import urllib.parse
+
+from prodigyclassic import hexdump
+from prodigyclassic.stage import segments, stagefile, structures
+
+
+REASONS = {200: 'OK', 206: 'Partial Content', 304: 'Not Modified',
+           400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 416: 'Range Not Satisfiable',
+           500: 'Internal Server Error'}
+
+
+def value_to_json(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    return str(value)
+
+
+def segment_to_json(factory, segment, number):
+    """A segment (and anything imbedded in it) as a dict"""
+    fields = {k: value_to_json(v) for k, v in sorted(vars(segment).items())
+              if not k.startswith('_') and k != 'object'}
+    item = {'number': number,
+            'type': segment.get_seg_type(),
+            'class': segment.__class__.__name__,
+            'length': len(segment._data),
+            'fields': fields,
+            'errors': [str(e) for e in segment.get_exceptions()]}
+    if isinstance(segment, segments.UnknownSegment):
+        item['data'] = segment.get_data().hex()
+    if isinstance(segment, segments.ImbeddedObjectSegment):
+        item['object'] = object_to_json(factory, segment.object)
+    return item
+
+
+def object_to_json(factory, obj):
+    return {'id': obj.id.get_id(True), 'length': obj.length,
+            'segments': [segment_to_json(factory, segment, number)
+                         for number, segment in
+                         enumerate(factory.parse_segments(obj))]}
+
+
+def decode_job(kind, data, max_segments, max_depth):
+    """Render an object's bytes; run here or in the process pool
+
+    kind is 'segments' or 'hexdump'. Returns (body, content type).
+    """
+    if kind == 'hexdump':
+        return (hexdump.HexDump()(bytes(data)) + '\n').encode(), \
+            'text/plain; charset=utf-8'
+    factory = segments.SegmentFactory(max_segments=max_segments,
+                                      max_depth=max_depth)
+    obj = structures.Object()
+    obj.unpack(bytes(data))
+    return (json.dumps(object_to_json(factory, obj)).encode(),
+            'application/json')
+
+
+def parse_range(header, length):
+    """Return (start, stop) for a Range header
+
+    Only a single byte range is handled; anything else (or anything that
+    doesn't parse) gets None and the whole thing is sent. A range past the
+    end raises HTTPError(416).
+    """
+    unit, sep, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not sep or ',' in spec:
+        return None
+    first, dash, last = spec.strip().partition('-')
+    if not dash:
+        return None
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                raise HTTPError(416, 'empty range')
+            return max(length - suffix, 0), length
+        start = int(first)
+        stop = int(last) + 1 if last else length
+    except ValueError:
+        return None
+    if last and stop <= start:
+        return None
+    if start >= length:
+        raise HTTPError(416, 'range starts past the end')
+    return start, min(stop, length)
+
+
+class Response:
+    def __init__(self, body=b'', content_type='application/json',
+                 status=200, etag=None, ranges=False):
+        self.body = body
+        self.content_type = content_type
+        self.status = status
+        self.etag = etag
+        # Whether a Range header applies
+        self.ranges = ranges
+        self.headers = {}
+
+
+class Image:
+    """One image being served
+
+    The file is reopened and remapped when it changes or is replaced, so
+    the ETags stay honest.
+    """
+    def __init__(self, name, filename):
+        self.name = name
+        self.filename = filename
+        self.f = None
+        self._stat = None
+        self.stage = None
+        self._names = None
+        self.refresh()
+
+    def refresh(self):
+        st = os.stat(self.filename)
+        key = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+        if key == self._stat:
+            return
+        # Reopened rather than remapped: it may have been replaced (written
+        # elsewhere and renamed over it), and a compressed map closes its
+        # file
+        f = open(self.filename, 'rb')
+        try:
+            stage = stagefile.StageFile(stagefile.map_file(f))
+            stage.load()
+        except BaseException:
+            f.close()
+            raise
+        self.close()
+        self.f = f
+        self._stat = key
+        self.stage = stage
+        self._names = None
+
+    def close(self):
+        if self.stage is not None:
+            try:
+                self.stage.close()
+            except BufferError:
+                # A view is still out; the map goes when it does
+                pass
+        if self.f is not None:
+            self.f.close()
+
+    @property
+    def etag(self):
+        checks = self.stage.dir.checks
+        return '"{0}-{1:x}-{2:x}"'.format(self.stage.prologue.curstartidx,
+                                         checks.mapcheck, checks.dircheck)
+
+    def find(self, obj_id):
+        """Return the directory index of NAME.EXT or an index"""
+        directory = self.stage.dir
+        if obj_id.isdigit():
+            obj_idx = int(obj_id)
+            if obj_idx < directory.inuse:
+                return obj_idx
+            raise HTTPError(404, 'no object {}'.format(obj_id))
+        if self._names is None:
+            self._names = {directory.get_entry(i).id.get_name(True): i
+                           for i in range(directory.inuse)}
+        try:
+            return self._names[obj_id.upper()]
+        except KeyError:
+            raise HTTPError(404, 'no object {}'.format(obj_id))
+
+    def entry_etag(self, obj_idx, kind):
+        entry = self.stage.dir.get_entry(obj_idx)
+        return '"{0:x}-{1:x}-{2:x}-{3}"'.format(entry.check, entry.startid,
+                                                entry.length, kind)
+
+    def info(self):
+        stage = self.stage
+        return {'name': self.name, 'file': self.filename,
+                'objects': stage.dir.inuse,
+                'generation': stage.prologue.curstartidx,
+                'au_size': stage.prologue.auquantasize}
+
+    def listing(self):
+        entries = []
+        for obj_idx in range(self.stage.dir.inuse):
+            entry = self.stage.dir.get_entry(obj_idx)
+            entries.append({'index': obj_idx,
+                            'name': entry.id.get_name(True),
+                            'location': entry.id.location,
+                            'type': entry.id.type,
+                            'status': entry.status,
+                            'length': entry.length,
+                            'startid': entry.startid,
+                            'check': entry.check,
+                            'version': entry.version.versionvalue,
+                            'store': entry.version.storecandidacy})
+        return entries
+
+
+class StageServer:
+    """Serve a set of images
+
+    processes is the size of the decoding pool (1 decodes everything in
+    the event loop). Objects of at least offload_size bytes go to the
+    pool. cache_size decoded responses are kept for all the images
+    together.
+    """
+
+    def __init__(self, filenames, processes=None, cache_size=256,
+                 offload_size=16384):
+        self.images = {}
+        for filename in filenames:
+            name = os.path.splitext(os.path.basename(filename))[0]
+            # Same name in different directories
+            base, n = name, 1
+            while name in self.images:
+                n += 1
+                name = '{0}-{1}'.format(base, n)
+            self.images[name] = Image(name, filename)
+        self.processes = processes
+        self.cache_size = cache_size
+        self.offload_size = offload_size
+        self.max_segments = segments.SegmentFactory.max_segments
+        self.max_depth = segments.SegmentFactory.max_depth
+
+        # (image, ETag) -> (body, content type), shared by all the images
+        self._cache = collections.OrderedDict()
+        # The same, for decoding that's under way
+        self._pending = {}
+        self._pool = None
+        self._server = None
+        self.requests = 0
+
+    async def start(self, host='127.0.0.1', port=8080):
+        if self.processes != 1:
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                self.processes)
+        self._server = await asyncio.start_server(self.handle, host, port)
+        return self._server
+
+    @property
+    def port(self):
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        for image in self.images.values():
+            image.close()
+
+    ### HTTP
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await reader.readline()
+                except ValueError:
+                    # Line too long
+                    break
+                if not request_line.strip():
+                    break
+                parts = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, sep, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                # Nothing here takes a body but don't misread one as the
+                # next request
+                length = headers.get('content-length', '0')
+                if length.isdigit() and int(length):
+                    await reader.readexactly(int(length))
+
+                if len(parts) != 3:
+                    method, response = 'GET', self.error(400, 'bad request')
+                else:
+                    method = parts[0]
+                    response = await self.respond(method, parts[1], headers)
+                writer.write(self.encode(method, response))
+                await writer.drain()
+                if (len(parts) != 3 or parts[2] == 'HTTP/1.0' or
+                        headers.get('connection', '').lower() == 'close'):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def encode(self, method, response):
+        lines = ['HTTP/1.1 {0} {1}'.format(response.status,
+                                           REASONS[response.status])]
+        headers = dict(response.headers)
+        if response.status != 304:
+            headers['Content-Type'] = response.content_type
+            headers['Content-Length'] = str(len(response.body))
+        if response.etag:
+            headers['ETag'] = response.etag
+        if response.ranges:
+            headers['Accept-Ranges'] = 'bytes'
+        lines.extend('{0}: {1}'.format(k, v) for k, v in headers.items())
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        if method == 'HEAD' or response.status == 304:
+            return head
+        return head + response.body
+
+    @staticmethod
+    def error(status, message):
+        return Response(json.dumps({'error': message}).encode(),
+                        status=status)
+
+    async def respond(self, method, target, headers):
+        self.requests += 1
+        if method not in ('GET', 'HEAD'):
+            response = self.error(405, 'read-only')
+            response.headers['Allow'] = 'GET, HEAD'
+            return response
+        try:
+            response = await self.route(target)
+            return self.conditional(response, headers)
+        except HTTPError as e:
+            response = self.error(e.status, e.value)
+            response.headers.update(e.headers)
+            return response
+        except Exception as e:
+            # Bad data in one object shouldn't take the server down
+            return self.error(500, '{0}: {1}'.format(e.__class__.__name__,
+                                                     e))
+
+    def conditional(self, response, headers):
+        """Apply If-None-Match and Range"""
+        match = headers.get('if-none-match')
+        if response.etag and match and (
+                match == '*' or response.etag in
+                [tag.strip() for tag in match.split(',')]):
+            return Response(status=304, etag=response.etag)
+
+        if response.ranges and 'range' in headers:
+            length = len(response.body)
+            try:
+                byte_range = parse_range(headers['range'], length)
+            except HTTPError as e:
+                e.headers['Content-Range'] = 'bytes */{}'.format(length)
+                raise
+            if byte_range is not None:
+                start, stop = byte_range
+                response.body = response.body[start:stop]
+                response.status = 206
+                response.headers['Content-Range'] = \
+                    'bytes {0}-{1}/{2}'.format(start, stop - 1, length)
+        return response
+
+    async def route(self, target):
+        path = urllib.parse.unquote(target.partition('?')[0])
+        parts = [part for part in path.split('/') if part]
+        if not parts:
+            body = [image.info() for image in self.images.values()]
+            return Response(json.dumps(body).encode())
+
+        image = self.images.get(parts[0])
+        if image is None:
+            raise HTTPError(404, 'no image {}'.format(parts[0]))
+        image.refresh()
+        if len(parts) == 1:
+            return Response(json.dumps(image.listing()).encode(),
+                            etag=image.etag)
+        if parts[1] != 'objects' or len(parts) not in (3, 4):
+            raise HTTPError(404, 'not found')
+
+        obj_idx = image.find(parts[2])
+        kind = parts[3] if len(parts) == 4 else 'raw'
+        if kind == 'raw':
+            entry = image.stage.dir.get_entry(obj_idx)
+            body = bytes(image.stage.read_object_data(entry))
+            return Response(body, 'application/octet-stream',
+                            etag=image.entry_etag(obj_idx, kind),
+                            ranges=True)
+        if kind not in ('segments', 'hexdump'):
+            raise HTTPError(404, 'not found')
+        body, content_type = await self.decoded(image, obj_idx, kind)
+        return Response(body, content_type,
+                        etag=image.entry_etag(obj_idx, kind), ranges=True)
+
+    ### decoding
+
+    async def decoded(self, image, obj_idx, kind):
+        """Return (body, content type) for an object, from the cache if
+        it's there"""
+        key = (image.name, image.entry_etag(obj_idx, kind))
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            return cached
+        # Someone else is already on it
+        if key in self._pending:
+            return await asyncio.shield(self._pending[key])
+
+        entry = image.stage.dir.get_entry(obj_idx)
+        data = bytes(image.stage.read_object_data(entry))
+        job = (kind, data, self.max_segments, self.max_depth)
+        if self._pool is not None and len(data) >= self.offload_size:
+            future = asyncio.get_running_loop().run_in_executor(
+                self._pool, decode_job, *job)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            try:
+                future.set_result(decode_job(*job))
+            except Exception as e:
+                future.set_exception(e)
+        self._pending[key] = future
+        try:
+            result = await future
+        finally:
+            del self._pending[key]
+        self._cache[key] = result
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+
+async def serve(filenames, host='127.0.0.1', port=8080, processes=None,
+                cache_size=256, offload_size=16384, ready=None):
+    """Run a StageServer until cancelled
+
+    ready(server) is called once it's listening.
+    """
+    server = StageServer(filenames, processes, cache_size, offload_size)
+    listener = await server.start(host, port)
+    if ready:
+        ready(server)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        await server.close()
+
+
+class HTTPError(Exception):
+    def __init__(self, status, value):
+        self.status = status
+        self.value = value
+        self.headers = {}
+
+    def __str__(self):
+        return repr(self.value)
@@ -0,0 +1,155 @@
+
+import collections
+import hashlib
+import json
+import os
+import random
+import zlib
+
+
+class MinHasher:
+    """MinHash signatures of byte strings
+
+    A payload is broken into overlapping shingle_size byte shingles. The
+    fraction of matching values in two signatures estimates how much the
+    two shingle sets overlap (their Jaccard similarity).
+    """
+
+    _prime = (1 << 61) - 1
+
+    def __init__(self, num_perm=64, shingle_size=4, seed=1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        # The same seed has to be used for everything in an index
+        rng = random.Random(seed)
+        self._perms = [(rng.randrange(1, self._prime),
+                        rng.randrange(0, self._prime))
+                       for dummy in range(num_perm)]
+
+    def shingles(self, data):
+        k = self.shingle_size
+        if len(data) < k:
+            return {zlib.crc32(data)}
+        # crc32 rather than hash(); it's the same from one run to the next
+        return {zlib.crc32(data[i:i + k]) for i in range(len(data) - k + 1)}
+
+    def signature(self, data):
+        xs = self.shingles(data)
+        p = self._prime
+        return [min((a * x + b) % p for x in xs) for a, b in self._perms]
+
+    @staticmethod
+    def similarity(sig_a, sig_b):
+        return sum(a == b for a, b in zip(sig_a, sig_b)) / len(sig_a)
+
+
+class SimilarityIndex:
+    """Locality sensitive hashing index of payload signatures
+
+    Signatures are cut into bands of rows values. Payloads sharing any band
+    land in the same bucket, so a query only looks at the few payloads that
+    share a bucket with it. Identical payloads are stored once with every
+    place they were seen. The index is a JSON file that can be added to at
+    any time.
+    """
+
+    def __init__(self, filename, num_perm=64, bands=16, shingle_size=4):
+        self.filename = filename
+        self.params = {'num_perm': num_perm, 'bands': bands,
+                       'shingle_size': shingle_size, 'seed': 1}
+        # payload digest -> {'sig': [...], 'seen': [[source, object,
+        # segment number, segment class], ...]}
+        self.items = {}
+        self.buckets = collections.defaultdict(list)
+        # object name -> digests of the payloads seen in it
+        self.objects = collections.defaultdict(list)
+        if os.path.exists(filename):
+            with open(filename) as f:
+                saved = json.load(f)
+            self.params = saved['params']
+            self.items = saved['items']
+            self.buckets.update(saved['buckets'])
+            if 'objects' in saved:
+                self.objects.update(saved['objects'])
+            else:
+                # Saved before there was a map
+                for digest, item in self.items.items():
+                    for where in item['seen']:
+                        self._add_object(where[1], digest)
+
+        self.hasher = MinHasher(self.params['num_perm'],
+                                self.params['shingle_size'],
+                                self.params['seed'])
+        self.rows = self.params['num_perm'] // self.params['bands']
+
+    def save(self):
+        temp = self.filename + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'params': self.params, 'items': self.items,
+                       'buckets': self.buckets, 'objects': self.objects}, f,
+                      separators=(',', ':'))
+        os.replace(temp, self.filename)
+
+    def band_keys(self, sig):
+        rows = self.rows
+        for band in range(self.params['bands']):
+            values = sig[band * rows:(band + 1) * rows]
+            yield '{0}:{1}'.format(band, hashlib.sha1(
+                ','.join(map(str, values)).encode()).hexdigest()[:16])
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha1(data).hexdigest()
+
+    def add(self, data, where):
+        """Add a payload seen at where; returns True if it was new"""
+        digest = self.digest(data)
+        sig = None
+        if digest not in self.items:
+            sig = self.hasher.signature(data)
+        return self.add_signature(digest, sig, where)
+
+    def add_signature(self, digest, sig, where):
+        """Like add() for a signature worked out elsewhere"""
+        self._add_object(where[1], digest)
+        item = self.items.get(digest)
+        if item is not None:
+            if where not in item['seen']:
+                item['seen'].append(where)
+            return False
+        self.items[digest] = {'sig': sig, 'seen': [where]}
+        for key in self.band_keys(sig):
+            self.buckets[key].append(digest)
+        return True
+
+    def _add_object(self, object_name, digest):
+        digests = self.objects[object_name]
+        if digest not in digests:
+            digests.append(digest)
+
+    def query(self, sig, threshold=0.5):
+        """Return [(similarity, digest)] for payloads like sig, best
+        first"""
+        candidates = set()
+        for key in self.band_keys(sig):
+            candidates.update(self.buckets.get(key, ()))
+        found = []
+        for digest in candidates:
+            similarity = self.hasher.similarity(sig,
+                                                self.items[digest]['sig'])
+            if similarity >= threshold:
+                found.append((similarity, digest))
+        found.sort(key=lambda f: (-f[0], f[1]))
+        return found
+
+    def find(self, object_name):
+        """Return the digests of the payloads seen in an object"""
+        return list(self.objects.get(object_name, ()))
+
+
+def signature_job(job):
+    """Work out a signature in another process: job is (params, data)"""
+    params, data = job
+    hasher = MinHasher(params['num_perm'], params['shingle_size'],
+                       params['seed'])
+    return SimilarityIndex.digest(data), hasher.signature(data)
@@ -0,0 +1,204 @@
+
+import gzip
+import hashlib
+import json
+import os
+import struct
+import time
+import zlib
+
+from prodigyclassic.stage import structures, writer
+
+
+class SnapshotStore:
+    """A directory holding many STAGE.DAT snapshots
+
+    Every object (and the prologue area) is kept once as a compressed blob
+    named by its SHA-1. Each snapshot is a manifest listing, for both
+    generations, the directory header and each entry with its blob.
+    Snapshots are rebuilt with StageWriter.
+
+        STORE/blobs/ab/cdef...     zlib compressed data
+        STORE/snapshots/NAME.json.gz
+        STORE/index.json           directory metadata -> blob
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.blob_dir = os.path.join(root, 'blobs')
+        self.snapshot_dir = os.path.join(root, 'snapshots')
+        self.index_file = os.path.join(root, 'index.json')
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+
+        # Objects with the same name, length, version and check are assumed
+        # to be the same, so they don't need to be read and hashed again
+        self.index = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+
+    ### blobs
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest[2:])
+
+    def has_blob(self, digest):
+        return os.path.exists(self.blob_path(digest))
+
+    def put_blob(self, data):
+        """Store data (if it isn't already) and return its digest"""
+        digest = hashlib.sha1(data).hexdigest()
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so a crash never leaves a bad blob
+            temp = path + '.tmp'
+            with open(temp, 'wb') as f:
+                f.write(zlib.compress(data))
+            os.replace(temp, path)
+        return digest
+
+    def get_blob(self, digest):
+        with open(self.blob_path(digest), 'rb') as f:
+            return zlib.decompress(f.read())
+
+    ### snapshots
+
+    @staticmethod
+    def metadata_key(entry):
+        return '{0}:{1:x}:{2:x}:{3:x}:{4:x}:{5:x}:{6:x}'.format(
+            entry.id.name.hex(), entry.id.location, entry.id.type,
+            entry.length, entry.version.byte1, entry.version.byte2,
+            entry.check)
+
+    def snapshot_path(self, name):
+        return os.path.join(self.snapshot_dir, name + '.json.gz')
+
+    def list_snapshots(self):
+        return sorted(name[:-len('.json.gz')]
+                      for name in os.listdir(self.snapshot_dir)
+                      if name.endswith('.json.gz'))
+
+    def ingest(self, stage, name, source=None, verify=False):
+        """Add a loaded StageFile as snapshot name
+
+        Only objects whose directory metadata hasn't been seen before are
+        read and hashed (all of them with verify). Returns the manifest and
+        the number of objects read.
+        """
+        if os.path.exists(self.snapshot_path(name)):
+            raise SnapshotException('snapshot {} already exists'
+                                    .format(name))
+        prologue = stage.prologue
+
+        # The prologue and anything sharing its AUs
+        reserved = 0
+        if prologue.austartoffset < prologue.size:
+            reserved = len(stage.AUM.get_chain(prologue.prologuestartid))
+        head = stage.read_offset(0, prologue.austartoffset +
+                                 reserved * prologue.auquantasize)
+
+        manifest = {
+            'name': name,
+            'source': source,
+            'ingested': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'length': len(stage.stage_map),
+            'head': self.put_blob(head),
+            'reserved': reserved,
+            'generations': [],
+        }
+        read = 0
+        for index in (0, 1):
+            aum = stage.AUMaps[index]
+            directory = stage.dirs[index]
+            entries = []
+            for obj_idx, entry in enumerate(directory.entrylist):
+                if obj_idx >= directory.inuse:
+                    entries.append([entry.pack().hex(), None])
+                    continue
+                key = self.metadata_key(entry)
+                digest = self.index.get(key)
+                if verify or digest is None or not self.has_blob(digest):
+                    data = stage.read_chain(aum.get_chain(entry.startid))
+                    digest = self.put_blob(data[:entry.length])
+                    self.index[key] = digest
+                    read += 1
+                entries.append([entry.pack().hex(), digest])
+
+            header = directory._format.pack(
+                directory.checks.pack(), directory.createdate,
+                directory.modifydate, directory.novclass.pack(),
+                directory.inuse, directory.maximum, directory.usageoff,
+                directory.entryoff)
+            manifest['generations'].append({
+                'header': header.hex(),
+                'aumcheck': aum.checks.pack().hex(),
+                'usage': directory.usagelist,
+                'entries': entries,
+            })
+
+        temp = self.snapshot_path(name) + '.tmp'
+        with gzip.open(temp, 'wt') as f:
+            json.dump(manifest, f, separators=(',', ':'))
+        os.replace(temp, self.snapshot_path(name))
+        with open(self.index_file + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(self.index_file + '.tmp', self.index_file)
+        return manifest, read
+
+    def load_manifest(self, name):
+        try:
+            with gzip.open(self.snapshot_path(name), 'rt') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise SnapshotException('no snapshot named {}'.format(name))
+
+    def rebuild(self, name):
+        """Return a StageWriter, ready to write(), for a snapshot"""
+        manifest = self.load_manifest(name)
+        head = self.get_blob(manifest['head'])
+        prologue = structures.Prologue()
+        prologue.unpack(head[:prologue.size])
+
+        directories = []
+        checks = []
+        for generation in manifest['generations']:
+            entries = [bytes.fromhex(entry) for entry, digest in
+                       generation['entries']]
+            directory = structures.Directory()
+            directory.maximum = len(entries)
+            directory.unpack(
+                bytes.fromhex(generation['header']) +
+                struct.pack('<{}H'.format(len(entries)),
+                            *[v + 1 for v in generation['usage']]) +
+                b''.join(entries))
+            aum_checks = structures.Check()
+            aum_checks.unpack(bytes.fromhex(generation['aumcheck']))
+            directories.append(directory)
+            checks.append(aum_checks)
+
+        stage_writer = writer.StageWriter(
+            prologue, directories, checks, head=head,
+            reserved=manifest['reserved'], length=manifest['length'])
+        # A blob used by both generations gets one chain
+        chains = {}
+        for index, generation in enumerate(manifest['generations']):
+            for obj_idx, (entry, digest) in enumerate(generation['entries']):
+                if digest is None:
+                    continue
+                if digest not in chains:
+                    size = directories[index].entrylist[obj_idx].length
+                    chains[digest] = stage_writer.add_chain(
+                        lambda digest=digest: self.get_blob(digest), size)
+                stage_writer.link(index, obj_idx, chains[digest])
+        stage_writer.layout()
+        return stage_writer
+
+
+class SnapshotException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
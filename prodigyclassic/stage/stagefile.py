@@ -1,7 +1,19 @@
 
+import bisect
+import collections
+import copy
+import mmap
 import os
 
-from prodigyclassic.stage import structures
+from prodigyclassic import compressed, instrument
+from prodigyclassic.stage import allocator, structures
+
+
+def map_file(f):
+    """Map an open (binary) STAGE.DAT read-only, compressed or not"""
+    if compressed.is_compressed(f):
+        return compressed.CompressedFile(f)
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
 
 class _StageStructure:
@@ -24,18 +36,19 @@ class _StageAUM(_StageStructure, structures.AUM):
 
     def load(self, index):
         stage = self.stage
-        stage.seek_AUid(stage.prologue.startids[index].mapstartid)
-        self.unpack(stage.read(self.size))
+        with instrument.phase('load_aum'):
+            stage.seek_AUid(stage.prologue.startids[index].mapstartid)
+            self.unpack(stage.read(self.size))
 
     def get_next(self, AUid=None):
         if AUid is None:
             AUid = self.stage.tell_AUid()
         return super().get_next(AUid)
 
-    def get_chain(self, AUid=None):
+    def get_chain(self, AUid=None, limit=None):
         if AUid is None:
             AUid = self.stage.tell_AUid()
-        return super().get_chain(AUid)
+        return super().get_chain(AUid, limit)
 
 
 class _StageDirectory(_StageStructure, structures.Directory):
@@ -46,29 +59,70 @@ class _StageDirectory(_StageStructure, structures.Directory):
     def load(self, index):
         # Everything except the prologue and AUMs are chain read
         AUid = self.stage.prologue.startids[index].dirstartid
-        data = self.stage.read_chain(AUid)
-        data = data[:self.size]
-        self.unpack(data)
+        chain = self.stage.AUMaps[index].get_chain(AUid)
+        with instrument.phase('load_dir'):
+            data = self.stage.read_chain(chain)
+            data = data[:self.size]
+            self.unpack(data)
 
 
 class _StageObject(_StageStructure, structures.Object):
-    def load(self, obj_id):
+    def load(self, obj_id, dir_entry=None):
         stage = self.stage
-        dir_entry = stage.dir.get_entry(obj_id)
-        data = stage.read_chain(dir_entry.startid)
-        data = data[:dir_entry.length]
+        if dir_entry is None:
+            dir_entry = stage.dir.get_entry(obj_id)
+            data = stage.read_chain(dir_entry.startid)
+            data = data[:dir_entry.length]
+        else:
+            data = bytes(stage.read_object_data(dir_entry))
         self.unpack(data)
 
 
+class _Generations:
+    """The AUMs or directories of both generations
+
+    Indexed like a list but each one is only loaded when it's first used.
+    """
+    def __init__(self, loader):
+        self._loader = loader
+        self._items = [None, None]
+
+    def __getitem__(self, index):
+        if self._items[index] is None:
+            self._items[index] = self._loader(index)
+        return self._items[index]
+
+    def __setitem__(self, index, item):
+        self._items[index] = item
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self._items)))
+
+    def is_loaded(self, index):
+        return self._items[index] is not None
+
+
 class StageFile:
+    # Number of decoded objects kept around
+    object_cache_size = 256
+
     def __init__(self, stage_map):
         self.stage_map = stage_map
 
         self.prologue = None
-        self.AUMaps = [None, None]
-        self.dirs = [None, None]
+        self.AUMaps = _Generations(self._read_AUM)
+        self.dirs = _Generations(self._read_dir)
         self.index = 0
 
+        # Objects are shared by both generations when their entries match
+        self._object_cache = collections.OrderedDict()
+        # The current generation's free space, built when first needed and
+        # then kept up to date by put_object and delete_object
+        self._allocator = None
+
     @property
     def AUM(self):
         return self.AUMaps[self.index]
@@ -83,11 +137,17 @@ class StageFile:
         self.index = index
 
     def load(self):
+        # The maps and directories are loaded as they're needed
         self.load_prologue()
-        self.load_AUMaps()
-        self.load_dirs()
+        self._allocator = None
         self.change_index()
 
+    def close(self):
+        """Drop the cached objects, which may be views of the map, and
+        close the map"""
+        self._object_cache.clear()
+        self.stage_map.close()
+
     def load_prologue(self):
         self.prologue = _StagePrologue(self)
         self.prologue.load()
@@ -97,16 +157,24 @@ class StageFile:
         self.load_AUM(1)
 
     def load_AUM(self, index):
-        self.AUMaps[index] = _StageAUM(self)
-        self.AUMaps[index].load(index)
+        self.AUMaps[index] = self._read_AUM(index)
+
+    def _read_AUM(self, index):
+        aum = _StageAUM(self)
+        aum.load(index)
+        return aum
 
     def load_dirs(self):
         self.load_dir(0)
         self.load_dir(1)
 
     def load_dir(self, index):
-        self.dirs[index] = _StageDirectory(self)
-        self.dirs[index].load(index)
+        self.dirs[index] = self._read_dir(index)
+
+    def _read_dir(self, index):
+        directory = _StageDirectory(self)
+        directory.load(index)
+        return directory
 
     def offset_to_AUid(self, offset):
         if offset < 0:
@@ -139,6 +207,9 @@ class StageFile:
         return self.read(length)
 
     def read_AUid(self, AUid, length=1):
+        if instrument.enabled:
+            instrument.count('aus_read', length)
+            instrument.count('bytes_read', self.prologue.auquantasize * length)
         self.seek_AUid(AUid)
         return self.read(self.prologue.auquantasize * length)
 
@@ -150,6 +221,17 @@ class StageFile:
             data.append(self.read_AUid(AUid))
         return b''.join(data)
 
+    def write_offset(self, offset, data):
+        self.stage_map[offset:offset + len(data)] = data
+
+    def update_offset(self, offset, data):
+        """Like write_offset() but only writes the AUs that changed"""
+        block = self.prologue.auquantasize
+        for i in range(0, len(data), block):
+            new = data[i:i + block]
+            if self.stage_map[offset + i:offset + i + len(new)] != new:
+                self.write_offset(offset + i, new)
+
     def tell(self):
         return self.stage_map.tell()
 
@@ -159,11 +241,344 @@ class StageFile:
     def tell_AUid(self):
         return self.offset_to_AUid(self.tell_offset())
 
+    def get_owners(self, index=None):
+        """Map every AU to whatever owns it
+
+        Returns a list indexed by AUid. Objects are given by their directory
+        index. The prologue, maps and directories are 'P', 'M0', 'M1', 'D0'
+        and 'D1'. Free and unreachable AUs are None. Each chain is only
+        walked once.
+        """
+        if index is None:
+            index = self.index
+        prologue = self.prologue
+        aum = self.AUMaps[index]
+        directory = self.dirs[index]
+        owners = [None] * len(aum.table)
+
+        def claim(owner, chain):
+            for AUid in chain:
+                if owners[AUid] is None:
+                    owners[AUid] = owner
+
+        def claim_chain(owner, AUid):
+            try:
+                claim(owner, aum.get_chain(AUid))
+            except structures.StructureException:
+                pass
+
+        if prologue.austartoffset < prologue.size:
+            claim_chain('P', prologue.prologuestartid)
+        map_AUs = -(-aum.size // prologue.auquantasize)
+        for i, startid in enumerate(prologue.startids):
+            first = startid.mapstartid
+            claim('M{}'.format(i),
+                  range(first, min(first + map_AUs, len(owners))))
+            claim_chain('D{}'.format(i), startid.dirstartid)
+        for obj_idx in range(directory.inuse):
+            claim_chain(obj_idx, directory.get_entry(obj_idx).startid)
+        return owners
+
     def get_object(self, obj_id):
+        """Return an object of the current generation
+
+        Decoded objects are cached by directory entry, so an object that's
+        the same in both generations is only read once. The same instance
+        is returned each time; don't change it.
+        """
+        return self._get_object(obj_id, self.dir.get_entry(obj_id))
+
+    def _get_object(self, obj_id, dir_entry, fast_read=False):
+        key = (dir_entry.id.name, dir_entry.id.location, dir_entry.id.type,
+               dir_entry.startid, dir_entry.length, dir_entry.check)
+        o = self._object_cache.get(key)
+        if o is not None:
+            instrument.count('object_cache_hits')
+            self._object_cache.move_to_end(key)
+            return o
+
+        instrument.count('objects_read')
         o = _StageObject(self)
-        o.load(obj_id)
+        with instrument.phase('read_object'):
+            o.load(obj_id, dir_entry if fast_read else None)
+        self._object_cache[key] = o
+        if len(self._object_cache) > self.object_cache_size:
+            self._object_cache.popitem(last=False)
         return o
 
+    def get_objects(self, obj_ids, raw=False, missing=None):
+        """Return several objects of the current generation at once
+
+        obj_ids are directory indexes, names (bytes) or ObjectIDs, resolved
+        together against the directory's index. The objects are read in the
+        order they're stored in the file but returned in the order asked
+        for. With raw each object's bytes (header included) are returned
+        instead, as memoryviews into the file where the object's AUs are in
+        one run; release them before closing the file.
+
+        Anything not in the directory raises ObjectNotFoundError listing
+        them all, unless missing is a list. Then they're appended to it and
+        None takes their place.
+        """
+        directory = self.dir
+        names = directory._entrylist_index
+        indexes = []
+        not_found = []
+        for obj_id in obj_ids:
+            if isinstance(obj_id, int):
+                obj_idx = obj_id if 0 <= obj_id < directory.inuse else None
+            elif isinstance(obj_id, bytes):
+                obj_idx = names.get(obj_id.rstrip())
+            elif isinstance(obj_id, structures.ObjectID):
+                obj_idx = names.get(obj_id.name)
+            else:
+                raise TypeError('specify int, bytes or ObjectID')
+            if obj_idx is None:
+                not_found.append(obj_id)
+            indexes.append(obj_idx)
+        if not_found:
+            if missing is None:
+                raise ObjectNotFoundError(not_found)
+            missing.extend(not_found)
+
+        # Each object once, in file order
+        entries = directory.entrylist
+        wanted = sorted(set(indexes) - {None},
+                        key=lambda obj_idx: entries[obj_idx].startid)
+        found = {None: None}
+        for obj_idx in wanted:
+            if raw:
+                found[obj_idx] = self.read_object_data(entries[obj_idx],
+                                                       view=True)
+            else:
+                found[obj_idx] = self._get_object(obj_idx, entries[obj_idx],
+                                                  fast_read=True)
+        return [found[obj_idx] for obj_idx in indexes]
+
+    def read_object_data(self, dir_entry, view=False):
+        """Read an object's bytes (header included)
+
+        Each run of consecutive AUs is read with one slice. With view the
+        result is a memoryview, straight into the file if the object is in
+        one run and the file allows it. Returns bytes or a memoryview.
+        """
+        chain = self.AUM.get_chain(dir_entry.startid)
+        auq = self.prologue.auquantasize
+        if instrument.enabled:
+            instrument.count('aus_read', len(chain))
+            instrument.count('bytes_read', auq * len(chain))
+        length = min(dir_entry.length, len(chain) * auq)
+
+        runs = []
+        first = last = chain[0]
+        for AUid in chain[1:]:
+            if AUid != last + 1:
+                runs.append((first, last))
+                first = AUid
+            last = AUid
+        runs.append((first, last))
+
+        if len(runs) == 1:
+            offset = self.AUid_to_offset(first)
+            if view:
+                try:
+                    return memoryview(self.stage_map)[offset:offset + length]
+                except TypeError:
+                    # Compressed files aren't buffers
+                    pass
+            data = self.stage_map[offset:offset + length]
+        else:
+            data = b''.join(self.stage_map[self.AUid_to_offset(first):
+                                           self.AUid_to_offset(last + 1)]
+                            for first, last in runs)[:length]
+        return memoryview(data) if view else data
+
+    ### writing
+
+    # Updates are copy-on-write. The current generation's map and directory
+    # are copied, changed and written over the other generation's. New
+    # object data only goes into AUs that are free in the current
+    # generation. Nothing the current generation uses is touched until the
+    # prologue's curstartidx is flipped, which is the very last write.
+
+    def put_object(self, data, status=None, check=None):
+        """Add an object or replace the one with the same name
+
+        data is the object including its 18 byte header. status and check
+        default to those of the object being replaced (or 1 and 0).
+        """
+        obj = structures.Object()
+        obj.unpack(bytes(data))
+        aum, directory, alloc = self._begin()
+
+        entry = structures.DirectoryEntry()
+        entry.id = obj.id
+        entry.length = obj.length
+        entry.version = obj.version
+        entry.status = 1 if status is None else status
+        entry.check = 0 if check is None else check
+
+        try:
+            obj_idx = directory.get_index(obj.id)
+        except KeyError:
+            obj_idx = None
+        if obj_idx is None and directory.inuse >= directory.maximum:
+            raise StageException('directory is full ({} entries)'
+                                 .format(directory.maximum))
+
+        # Allocate before freeing anything; the AUs of the object being
+        # replaced are still in use until the flip.
+        chain = alloc.allocate(-(-len(obj._data) //
+                                 self.prologue.auquantasize))
+        entry.startid = chain[0]
+        self._write_chain(chain, obj._data)
+
+        if obj_idx is not None:
+            old = directory.entrylist[obj_idx]
+            if status is None:
+                entry.status = old.status
+            if check is None:
+                entry.check = old.check
+            alloc.free(aum.get_chain(old.startid))
+
+        if obj_idx is not None:
+            directory.entrylist[obj_idx] = entry
+        else:
+            # Keep the directory sorted by name
+            names = [e.id.name for e in directory.entrylist[:directory.inuse]]
+            obj_idx = bisect.bisect(names, entry.id.name)
+            directory.entrylist.insert(obj_idx, entry)
+            directory.entrylist.pop()
+            directory.inuse += 1
+            self._shift_usage(directory, obj_idx, 1)
+
+        self._commit(aum, directory, alloc)
+        return obj_idx
+
+    def delete_object(self, obj_id):
+        """Remove an object, given by name or directory index"""
+        aum, directory, alloc = self._begin()
+        if not isinstance(obj_id, int):
+            obj_id = directory.get_index(obj_id)
+        if not 0 <= obj_id < directory.inuse:
+            raise StageException('no object at index {}'.format(obj_id))
+
+        alloc.free(aum.get_chain(directory.entrylist[obj_id].startid))
+        directory.entrylist.pop(obj_id)
+        blank = structures.DirectoryEntry()
+        blank.unpack(bytes(blank.size))
+        directory.entrylist.append(blank)
+        directory.inuse -= 1
+        self._shift_usage(directory, obj_id, -1)
+
+        self._commit(aum, directory, alloc)
+
+    def _begin(self):
+        # Copy the current generation's map, directory and free space
+        current = self.prologue.curstartidx
+        aum = copy.copy(self.AUMaps[current])
+        aum.table = list(aum.table)
+        directory = copy.copy(self.dirs[current])
+        directory.entrylist = list(directory.entrylist)
+        directory.usagelist = list(directory.usagelist)
+        return aum, directory, self._current_allocator().copy(aum)
+
+    def _commit(self, aum, directory, alloc=None):
+        prologue = self.prologue
+        current = prologue.curstartidx
+        new = 1 - current
+
+        # The new generation gets its own stamps
+        # TODO: check RS source for how these are really generated
+        checks = self.AUMaps[current].checks
+        aum.checks = structures.Check((checks.mapcheck + 1) & 0xffff,
+                                      (checks.dircheck + 1) & 0xffff)
+        directory.checks = aum.checks
+        directory._create_index()
+
+        # Make sure the object data is down before the map and directory
+        # pointing at it.
+        self.flush()
+        startid = prologue.startids[new]
+        self.update_offset(self.AUid_to_offset(startid.mapstartid),
+                           aum.pack())
+        dir_chain = aum.get_chain(startid.dirstartid)
+        self._write_chain(dir_chain, directory.pack())
+        self.flush()
+
+        # Flip
+        new_prologue = copy.copy(prologue)
+        new_prologue.curstartidx = new
+        self.update_offset(0, new_prologue.pack())
+        self.flush()
+
+        prologue.curstartidx = new
+        # Freed AUs may have been reused
+        self._object_cache.clear()
+        self.AUMaps[new] = aum
+        self.dirs[new] = directory
+        self._allocator = alloc
+        self.change_index(new)
+
+    def get_allocator(self, aum=None):
+        """Return an ExtentAllocator for an AUM (default: the one in use)
+
+        Only AUs entirely inside the file are handed out. A new allocator
+        means going through the whole table; the one for the current
+        generation is kept and updated as objects are put and deleted.
+        Allocating from it changes the live map, so take a copy() of it
+        (and of the AUM) to try things out.
+        """
+        if aum is None:
+            if self.index == self.prologue.curstartidx:
+                return self._current_allocator()
+            aum = self.AUM
+        return allocator.ExtentAllocator(
+            aum, self.prologue.prologuestartid,
+            self.offset_to_AUid(len(self.stage_map)))
+
+    def _current_allocator(self):
+        if self._allocator is None:
+            self._allocator = allocator.ExtentAllocator(
+                self.AUMaps[self.prologue.curstartidx],
+                self.prologue.prologuestartid,
+                self.offset_to_AUid(len(self.stage_map)))
+        return self._allocator
+
+    def _write_chain(self, chain, data):
+        block = self.prologue.auquantasize
+        data = bytes(data).ljust(len(chain) * block, b'\0')
+        for i, AUid in enumerate(chain):
+            self.update_offset(self.AUid_to_offset(AUid),
+                               data[i * block:(i + 1) * block])
+
+    @staticmethod
+    def _shift_usage(directory, obj_idx, delta):
+        # TODO: check RS source. This assumes the usage list starts with
+        # the indexes of the entries in use (range(inuse) for a new image,
+        # see writer.new_image) and is padded out with -1 or, in some
+        # images, each slot's own index. Call after inuse has changed.
+        inuse = directory.inuse - delta
+        used = directory.usagelist[:inuse]
+        spare = directory.usagelist[inuse:]
+        if delta > 0:
+            used = [v + 1 if v >= obj_idx else v for v in used]
+            used.insert(obj_idx, obj_idx)
+            spare = spare[1:]
+        else:
+            used = [v - 1 if v > obj_idx else v
+                    for v in used if v != obj_idx]
+            spare.insert(0, inuse - 1 if spare and spare[0] == inuse
+                         else -1)
+        directory.usagelist = used + spare
+
+    def flush(self):
+        try:
+            self.stage_map.flush()
+        except (TypeError, ValueError, OSError):
+            # Anonymous and read-only maps can't be flushed
+            pass
+
 
 class StageException(Exception):
     def __init__(self, value):
@@ -171,3 +586,7 @@ class StageException(Exception):
 
     def __str__(self):
         return repr(self.value)
+
+
+class ObjectNotFoundError(StageException):
+    pass
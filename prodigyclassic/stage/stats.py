@@ -0,0 +1,204 @@
+
+"""Object and segment counts over one or more images
+
+The object type, version and size histograms come from the directory, so
+they're always exact. Segments have to be decoded. Either every object is
+decoded or a random sample of them (picked by directory index). With a
+sample, the segment totals are estimated from the sample's per-object
+means, with a normal approximation confidence interval corrected for the
+finite population. Each image is sampled separately and the estimates
+added up.
+"""
+
+import collections
+import math
+import random
+import statistics
+
+from prodigyclassic.stage import segments
+
+
+GROUPS = ('object type', 'version', 'size')
+SEGMENT_GROUPS = ('segment type', 'segment bytes')
+
+
+def size_bucket(length):
+    """Power of two size range for an object length, e.g. '256-511'"""
+    if length < 64:
+        return '0-63'
+    low = 1 << (length.bit_length() - 1)
+    return '{0}-{1}'.format(low, 2 * low - 1)
+
+
+def segment_name(segment):
+    st = segment.get_seg_type()
+    name = segment.__class__.__name__
+    return name if st is None else '{0:#04x} {1}'.format(st, name)
+
+
+class Stratum:
+    """Per-object sums over the objects decoded from one image"""
+
+    def __init__(self, population, sampled):
+        self.population = population
+        self.sampled = sampled
+        self.sums = collections.Counter()
+        self.squares = collections.Counter()
+
+    def add(self, values):
+        for key, value in values.items():
+            self.sums[key] += value
+            self.squares[key] += value * value
+
+    def estimate(self, key):
+        """Return (estimated total, its variance)
+
+        The variance is None when there's no telling (one object sampled
+        out of several).
+        """
+        n = self.sampled
+        if not n:
+            return 0, 0
+        mean = self.sums[key] / n
+        total = self.population * mean
+        if n >= self.population:
+            return total, 0
+        if n < 2:
+            return total, None
+        s2 = max(self.squares[key] - n * mean * mean, 0) / (n - 1)
+        return total, (self.population ** 2 * (1 - n / self.population) *
+                       s2 / n)
+
+
+class Stats:
+    def __init__(self, factory=None, skip_imbedded=False, seed=None):
+        self.factory = factory or segments.SegmentFactory()
+        self.skip_imbedded = skip_imbedded
+        self.rnd = random.Random(seed)
+        self.images = 0
+        self.objects = 0
+        self.bytes = 0
+        # Exact counts from the directories, group -> key -> objects
+        self.counts = {group: collections.Counter() for group in GROUPS}
+        self.strata = []
+
+    def sample_size(self, population, sample):
+        """sample is None (everything), a count or a fraction"""
+        if sample is None:
+            return population
+        if isinstance(sample, float):
+            return min(population, max(1, round(population * sample)))
+        return min(population, sample)
+
+    def add_image(self, stage, sample=None, progress=None):
+        """Count an image's objects and decode all or a sample of them"""
+        directory = stage.dir
+        population = directory.inuse
+        self.images += 1
+        self.objects += population
+        for obj_idx in range(population):
+            entry = directory.get_entry(obj_idx)
+            self.bytes += entry.length
+            self.counts['object type'][
+                '{0:#x}'.format(entry.id.type)] += 1
+            self.counts['version'][
+                '{0:#x}'.format(entry.version.versionvalue)] += 1
+            self.counts['size'][size_bucket(entry.length)] += 1
+
+        n = self.sample_size(population, sample)
+        indexes = (range(population) if n >= population else
+                   self.rnd.sample(range(population), n))
+        stratum = Stratum(population, n)
+        # A cache's worth at a time, each lot read in file order
+        chunk = stage.object_cache_size
+        for i in range(0, len(indexes), chunk):
+            for obj in stage.get_objects(indexes[i:i + chunk]):
+                values = self.object_values(obj)
+                stratum.add(values)
+                if progress:
+                    progress.update(1, values[('total', 'segments')],
+                                    obj.length)
+        self.strata.append(stratum)
+
+    def object_values(self, obj):
+        values = collections.Counter()
+        pending = [obj]
+        while pending:
+            current = pending.pop()
+            for segment in self.factory.parse_segments(current):
+                name = segment_name(segment)
+                values[('total', 'segments')] += 1
+                values[('segment type', name)] += 1
+                values[('segment bytes', name)] += len(segment._data)
+                if isinstance(segment, segments.ImbeddedObjectSegment):
+                    values[('total', 'imbedded objects')] += 1
+                    if not self.skip_imbedded:
+                        pending.append(segment.object)
+        return values
+
+    @property
+    def sampled(self):
+        return sum(stratum.sampled for stratum in self.strata)
+
+    @property
+    def exact(self):
+        return self.sampled >= self.objects
+
+    def estimate(self, key, z):
+        """Return (estimate, low, high) added up over the images
+
+        low and high are None if any image's interval is unbounded.
+        """
+        total = variance = 0
+        for stratum in self.strata:
+            t, v = stratum.estimate(key)
+            total += t
+            if v is None or variance is None:
+                variance = None
+            else:
+                variance += v
+        if variance is None:
+            return total, None, None
+        margin = z * math.sqrt(variance)
+        return total, max(total - margin, 0), total + margin
+
+    def report(self, confidence=0.95):
+        """Return everything as a dict (that goes to JSON)
+
+        Each group is a list of [key, count, share] for exact counts or
+        [key, estimate, low, high, share] for estimates, biggest first
+        (sizes are smallest first). low and high are None (null) when the
+        interval is unbounded.
+        """
+        z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+        report = {'images': self.images, 'objects': self.objects,
+                  'bytes': self.bytes, 'sampled': self.sampled,
+                  'exact': self.exact, 'confidence': confidence}
+
+        for group in GROUPS:
+            rows = [[key, count, count / (self.objects or 1)]
+                    for key, count in self.counts[group].most_common()]
+            if group == 'size':
+                rows.sort(key=lambda row: int(row[0].split('-')[0]))
+            report[group] = rows
+
+        keys = set()
+        for stratum in self.strata:
+            keys.update(stratum.sums)
+        for name in ('segments', 'imbedded objects'):
+            report[name] = self._values(('total', name), z)
+        for group in SEGMENT_GROUPS:
+            rows = [[key] + self._values((g, key), z)
+                    for g, key in keys if g == group]
+            whole = sum(row[1] for row in rows) or 1
+            for row in rows:
+                row.append(row[1] / whole)
+            rows.sort(key=lambda row: (-row[1], row[0]))
+            report[group] = rows
+        return report
+
+    def _values(self, key, z):
+        estimate, low, high = self.estimate(key, z)
+        if self.exact:
+            return [round(estimate)]
+        return [estimate, low, high]
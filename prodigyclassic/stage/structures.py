@@ -13,6 +13,9 @@ class Reader(reader.Reader):
 
 
 class Check:
+    # TODO: check the RS source. These don't look like checksums. An AUM
+    # and the directory of the same generation carry the same values, so
+    # they seem to be stamps that tie the two together.
     _format = struct.Struct('<HH')
     size = _format.size
 
@@ -99,8 +102,8 @@ class ObjectID:
             self.name = None
 
     def pack(self):
-        return self._format.pack('{:11}'.format(self.name), self.location,
-                                 self.type)
+        name = self.name if self.name is not None else bytes(11)
+        return self._format.pack(name.ljust(11), self.location, self.type)
 
     def __repr__(self):
         return ('{0}(name={1}, location={2}, type_=0x{3:#x})'
@@ -161,6 +164,10 @@ class StartID:
 
 
 class Prologue:
+    # I have a Windows version that follows with an object-id for
+    # RCO id and 00 1D 63. None of these are used for reading from or
+    # writing to the STAGE.DAT.
+    # TODO: Are those last three bytes like DirectoryEntry's status?
     _format = struct.Struct('<8H4s4s2H')
     size = _format.size
 
@@ -197,16 +204,37 @@ class Prologue:
         self.startids[0].unpack(startids_0)
         self.startids[1].unpack(startids_1)
 
-        # I have a Windows version that follows with an object-id for
-        # RCO id and 00 1D 63. None of these are used for reading from or
-        # writing to the STAGE.DAT.
-        # TODO: Are those last three bytes like DirectoryEntry's status?
+    def pack(self):
+        return self._format.pack(
+            self.structurelevel,
+            self.class_,
+            self.auquantasize,
+            self.austartoffset,
+            self.mapwidth,
+            self.maxmapentries,
+            self.dirtotbytesize,
+            self.curstartidx,
+            self.startids[0].pack(),
+            self.startids[1].pack(),
+            self.prologuestartid,
+            self.check,
+        )
 
 
 class AUM:
     FreeEntryValue = 0x00
     EolEntryValue = 0x01
 
+    # Kinds of runs returned by get_runs()
+    InvalidRun = 'invalid'
+    ConsecutiveRun = 'consecutive'
+    EolRun = 'eol'
+    FreeRun = 'free'
+    JumpRun = 'jump'
+
+    # Longest chain get_chain() follows (None for the number of entries)
+    max_chain_length = None
+
     def __init__(self, width, startid, entries):
         self.width = width
         self.startid = startid
@@ -226,30 +254,120 @@ class AUM:
 
         # Get and remove the checks from the data
         self.checks.unpack(data[0:self.checks.size])
-        # We're working with bytes so this creates a nice list of integers
-        # for us
-        data = list(data[self.checks.size:])
+        data = bytes(data[self.checks.size:])
 
         # The first couple entries aren't real
         self.table = [self.EolEntryValue] * self.startid
-        mask = (1 << self.width) - 1
+        # Remember that we already added some entries
+        self.table.extend(self._unpack_table(data,
+                                             self.entries - self.startid))
+
+    def _unpack_table(self, data, count):
+        width = self.width
+        if width == 8:
+            return list(data[:count])
+        if width == 16:
+            return list(struct.unpack_from('<{}H'.format(count), data))
+        if width == 12:
+            # Every 3 bytes hold 2 entries. Work on whole columns of bytes
+            # at a time.
+            pairs = (count + 1) // 2
+            data = data[:pairs * 3].ljust(pairs * 3, b'\0')
+            low, middle, high = data[0::3], data[1::3], data[2::3]
+            table = [0] * (pairs * 2)
+            table[0::2] = [lo | (mid & 0x0f) << 8
+                           for lo, mid in zip(low, middle)]
+            table[1::2] = [mid >> 4 | hi << 4
+                           for mid, hi in zip(middle, high)]
+            return table[:count]
+
+        table = []
+        mask = (1 << width) - 1
         reg = 0
         bit_count = 0
-        # Remember that we already added some entries
-        for dummy in range(0, self.entries - self.startid):
+        i = 0
+        for dummy in range(0, count):
 
             # If we don't have the required number of bytes then
             # shift in another byte and put it on the left of any
             # remaining bits. (little-endian)
-            while bit_count < self.width:
-                reg |= data.pop(0) << bit_count
+            while bit_count < width:
+                reg |= data[i] << bit_count
+                i += 1
                 bit_count += 8
 
-            self.table.append(reg & mask)
+            table.append(reg & mask)
 
             # Shift out the used bits
-            reg >>= self.width
-            bit_count -= self.width
+            reg >>= width
+            bit_count -= width
+        return table
+
+    def pack(self):
+        data = self._pack_table(self.table[self.startid:self.entries])
+        table_size = self.size - self.checks.size
+        return self.checks.pack() + data.ljust(table_size, b'\0')
+
+    def _pack_table(self, values):
+        width = self.width
+        if width == 8:
+            return bytes(values)
+        if width == 16:
+            return struct.pack('<{}H'.format(len(values)), *values)
+        if width == 12:
+            if len(values) % 2:
+                values = values + [0]
+            even, odd = values[0::2], values[1::2]
+            data = bytearray(len(values) // 2 * 3)
+            data[0::3] = bytes(e & 0xff for e in even)
+            data[1::3] = bytes(e >> 8 | (o & 0x0f) << 4
+                               for e, o in zip(even, odd))
+            data[2::3] = bytes(o >> 4 for o in odd)
+            return bytes(data)
+
+        mask = (1 << width) - 1
+        data = bytearray()
+        reg = 0
+        bit_count = 0
+        for v in values:
+            reg |= (v & mask) << bit_count
+            bit_count += width
+            while bit_count >= 8:
+                data.append(reg & 0xff)
+                reg >>= 8
+                bit_count -= 8
+        if bit_count:
+            data.append(reg)
+        return bytes(data)
+
+    def get_runs(self):
+        """Classify the table into (kind, first AUid, count) runs
+
+        A jump (the next AU isn't the following one) is always a run of one.
+        """
+        runs = []
+        if self.startid:
+            runs.append((self.InvalidRun, 0, min(self.startid,
+                                                 len(self.table))))
+        kind = None
+        first = self.startid
+        for AUid, v in enumerate(self.table[self.startid:], self.startid):
+            if v == AUid + 1:
+                k = self.ConsecutiveRun
+            elif v == self.EolEntryValue:
+                k = self.EolRun
+            elif v == self.FreeEntryValue:
+                k = self.FreeRun
+            else:
+                k = self.JumpRun
+            if k is not kind or k is self.JumpRun:
+                if kind is not None:
+                    runs.append((kind, first, AUid - first))
+                kind = k
+                first = AUid
+        if kind is not None:
+            runs.append((kind, first, len(self.table) - first))
+        return runs
 
     def get_next(self, AUid):
         try:
@@ -262,10 +380,21 @@ class AUM:
             raise AUnotAllocatedError('AU {} is not allocated'.format(AUid))
         return n
 
-    def get_chain(self, AUid):
+    def get_chain(self, AUid, limit=None):
+        """Follow a chain from AUid
+
+        A chain longer than limit AUs (by default max_chain_length or, if
+        that's None, the number of entries) raises AUchainTooLongError.
+        Without a limit a loop in the map would never end.
+        """
+        if limit is None:
+            limit = self.max_chain_length or len(self.table)
         chain = []
         while True:
             chain.append(AUid)
+            if len(chain) > limit:
+                raise AUchainTooLongError('chain from AU {0} is longer than '
+                                          '{1} AUs'.format(chain[0], limit))
             try:
                 AUid = self.get_next(AUid)
             except AUendOfList:
@@ -337,6 +466,38 @@ class Directory:
             self.entrylist.append(entry)
         self._create_index()
 
+    def pack(self):
+        data = [
+            self._format.pack(
+                self.checks.pack(),
+                self.createdate,
+                self.modifydate,
+                self.novclass.pack(),
+                self.inuse,
+                self.maximum,
+                self.usageoff,
+                self.entryoff,
+            ),
+            struct.pack('<{}H'.format(self.maximum),
+                        *[v + 1 for v in self.usagelist]),
+        ]
+        # Pack all the entries with one (big) struct rather than one at a
+        # time.
+        fields = []
+        for entry in self.entrylist:
+            name = entry.id.name if entry.id.name is not None else bytes(11)
+            fields.extend((name.ljust(11), entry.id.location, entry.id.type,
+                           entry.unused, entry.status, entry.length,
+                           entry.startid, entry.version.byte1,
+                           entry.version.byte2, entry.check))
+        data.append(struct.pack('<' + DirectoryEntry._flat_format *
+                                len(self.entrylist), *fields))
+        data = b''.join(data)
+        if len(data) > self.size:
+            raise PackError('directory needs {} bytes but only {} are '
+                            'available'.format(len(data), self.size))
+        return data.ljust(self.size, b'\0')
+
     def _create_index(self):
         self._entrylist_index = {entry.id.name: index
                                  for (index, entry) in
@@ -361,9 +522,12 @@ class Directory:
 class DirectoryEntry:
     _format = struct.Struct('<13sBHHH2sH')
     size = _format.size
+    # The same with the ObjectID and VersionID fields broken out
+    _flat_format = '11sBBBHHHBBH'
 
     def __init__(self):
         self.id = ObjectID()
+        self.unused = 0
         self.status = None
         self.length = None
         self.startid = None  # originally AUidt (Wordt)
@@ -377,7 +541,7 @@ class DirectoryEntry:
             raise UnpackError('expecting {} bytes'.format(self.size))
         (
             id_,
-            dummy,  # seemingly unused
+            self.unused,  # seemingly unused
             self.status,
             self.length,
             self.startid,
@@ -387,6 +551,17 @@ class DirectoryEntry:
         self.id.unpack(id_)
         self.version.unpack(version)
 
+    def pack(self):
+        return self._format.pack(
+            self.id.pack(),
+            self.unused,
+            self.status,
+            self.length,
+            self.startid,
+            self.version.pack(),
+            self.check,
+        )
+
     def set_from_object(self, obj):
         """Create a bare-bones directory entry from an object's header"""
 
@@ -408,7 +583,8 @@ class Object:
         self.setsize = 0
         self.version = VersionID()
         self.header = b''
-        self.data = b''
+        # How many objects deep this one is imbedded (0 if it isn't)
+        self.depth = 0
 
         self._data = b''
 
@@ -416,9 +592,16 @@ class Object:
     def size(self):
         return self.length or self._format.size
 
+    @property
+    def data(self):
+        # A view so the payload isn't copied. Imbedded objects are views of
+        # their parent's data all the way down.
+        return memoryview(self._data)[self._format.size:]
+
     _format = struct.Struct('<13sHBBB')
 
     def unpack(self, data):
+        """Unpack the header; data may be bytes or a memoryview"""
 
         self._data = data
 
@@ -430,7 +613,7 @@ class Object:
             storeflags,
             self.setsize,
             version,
-        ) = self._format.unpack(data[0:18])
+        ) = self._format.unpack_from(data)
         self.id.unpack(id_)
         self.version = VersionID(version, storeflags)
 
@@ -438,16 +621,13 @@ class Object:
         if len(data) != self.size:
             raise UnpackError('expecting {} bytes'.format(self.size))
 
-        # Loose the header and save the data
-        self.data = data[18:]
-
     def get_header(self):
-        return self._data[:self._format.size]
+        return bytes(self._data[:self._format.size])
 
     def get_data(self, with_header=False):
         if not with_header:
-            return self.data
-        return self._data
+            return bytes(self.data)
+        return bytes(self._data)
 
 
 class StructureException(Exception):
@@ -470,5 +650,13 @@ class AUdoesNotExistError(StructureException):
     pass
 
 
+class AUchainTooLongError(StructureException):
+    pass
+
+
 class UnpackError(StructureException):
     pass
+
+
+class PackError(StructureException):
+    pass
@@ -0,0 +1,288 @@
+
+import copy
+import math
+
+from prodigyclassic.stage import structures
+
+
+class StageWriter:
+    """Lay out and write a complete STAGE.DAT image
+
+    Everything goes in AU order with no gaps: the prologue, both AUMs, both
+    directories and then the chains in the order they were added. A chain
+    linked from both directories is shared by both generations.
+    """
+
+    def __init__(self, prologue, directories, checks, head=b'',
+                 reserved=None, length=0):
+        # The prologue supplies the geometry. Its startids get filled in.
+        self.prologue = prologue
+        # Directories (and Checks) for generation 0 and 1. The directories
+        # are copied before their entries' startids are changed.
+        self.directories = directories
+        self.checks = checks
+        # Template for everything before the AUMs. The prologue is packed
+        # over the beginning of it.
+        self.head = head
+        # Number of AUs holding the prologue (if any)
+        if reserved is None:
+            reserved = math.ceil(max(prologue.size - prologue.austartoffset,
+                                     0) / prologue.auquantasize)
+        self.reserved = reserved
+        # Minimum length of the image
+        self.length = length
+
+        self.chains = []
+        self.links = [[], []]
+
+        self.AUMaps = None
+        self.startids = None
+
+    def add_chain(self, data, size=None):
+        """Add chain data and return its index
+
+        data may be a callable returning the data, in which case size must
+        be given. It's not called until write().
+        """
+        if size is None:
+            size = len(data)
+        self.chains.append((data, size))
+        return len(self.chains) - 1
+
+    def link(self, index, entry_index, chain):
+        """Point directory[index].entrylist[entry_index] at a chain"""
+        self.links[index].append((entry_index, chain))
+
+    def AU_count(self, size):
+        return max(math.ceil(size / self.prologue.auquantasize), 1)
+
+    def layout(self):
+        """Assign AUs to everything and build both AUMs"""
+        prologue = self.prologue
+        start = prologue.prologuestartid
+        entries = prologue.maxmapentries
+
+        table = ([structures.AUM.EolEntryValue] * start +
+                 [structures.AUM.FreeEntryValue] * (entries - start))
+        # Tables shared by both generations are marked first
+        tables = [table, None]
+        next_AUid = start
+
+        def allocate(size, marks):
+            nonlocal next_AUid
+            count = self.AU_count(size)
+            first = next_AUid
+            next_AUid += count
+            if next_AUid > entries:
+                raise structures.PackError('image is full ({} AUs)'
+                                           .format(entries))
+            for t in marks:
+                for AUid in range(first, first + count - 1):
+                    t[AUid] = AUid + 1
+                t[first + count - 1] = structures.AUM.EolEntryValue
+            return first
+
+        if self.reserved:
+            allocate(self.reserved * prologue.auquantasize, [table])
+
+        aum_size = structures.AUM(prologue.mapwidth, start, entries).size
+        map_startids = [allocate(aum_size, [table]) for dummy in range(2)]
+        dir_startids = [allocate(prologue.dirtotbytesize, [table])
+                        for dummy in range(2)]
+        tables[1] = list(table)
+
+        # Now the chains. Only the generations linking to a chain get it
+        # marked as allocated.
+        users = [set() for dummy in self.chains]
+        for index in (0, 1):
+            for entry_index, chain in self.links[index]:
+                users[chain].add(index)
+        chain_startids = [allocate(size, [tables[i] for i in users[chain]])
+                          for chain, (data, size) in enumerate(self.chains)]
+
+        self.AUMaps = []
+        for index in (0, 1):
+            aum = structures.AUM(prologue.mapwidth, start, entries)
+            aum.table = tables[index]
+            aum.checks = self.checks[index]
+            self.AUMaps.append(aum)
+
+        self.startids = chain_startids
+        self.end_AUid = next_AUid
+        prologue.startids = [structures.StartID(map_startids[i],
+                                                dir_startids[i])
+                             for i in (0, 1)]
+
+        directories = []
+        for index in (0, 1):
+            directory = copy.copy(self.directories[index])
+            directory.checks = self.checks[index]
+            directory.entrylist = list(directory.entrylist)
+            for entry_index, chain in self.links[index]:
+                entry = copy.copy(directory.entrylist[entry_index])
+                entry.startid = chain_startids[chain]
+                directory.entrylist[entry_index] = entry
+            directories.append(directory)
+        self.directories = directories
+
+    # Output is gathered into blocks of this size before being written
+    block_size = 1 << 20
+
+    def write(self, f):
+        """Write the image to a binary file object"""
+        if self.AUMaps is None:
+            self.layout()
+        prologue = self.prologue
+        auq = prologue.auquantasize
+        written = 0
+        buffer = bytearray()
+
+        def flush():
+            nonlocal written
+            written += f.write(buffer)
+            del buffer[:]
+
+        def put(data, count):
+            data = bytes(data)
+            if len(data) > count * auq:
+                raise structures.PackError('{} bytes do not fit in {} AUs'
+                                           .format(len(data), count))
+            buffer.extend(data)
+            buffer.extend(bytes(count * auq - len(data)))
+            if len(buffer) >= self.block_size:
+                flush()
+
+        head_size = prologue.austartoffset + self.reserved * auq
+        head = prologue.pack() + self.head[prologue.size:head_size]
+        buffer.extend(head.ljust(head_size, b'\0'))
+
+        for aum in self.AUMaps:
+            put(aum.pack(), self.AU_count(aum.size))
+        for directory in self.directories:
+            put(directory.pack()[:prologue.dirtotbytesize],
+                self.AU_count(prologue.dirtotbytesize))
+        for data, size in self.chains:
+            if callable(data):
+                data = data()
+            put(data, self.AU_count(size))
+        flush()
+
+        if written < self.length:
+            written += f.write(bytes(self.length - written))
+        return written
+
+
+def new_image(objects, template=None, au_size=128, map_width=None,
+              dir_entries=None, spare=0):
+    """Lay out a new image holding objects
+
+    objects is a list of (data, status, check) where data is the object
+    including its header. Both generations get the same directory, sorted
+    by name. template, a loaded StageFile, supplies the geometry and the
+    prologue and directory header fields. Otherwise au_size and map_width
+    are used; without a map_width the narrowest of 8, 12 and 16 bits that
+    maps every AU is picked. dir_entries is the directory size (default: just enough) and
+    spare is the number of free AUs to leave.
+
+    Returns a StageWriter that's ready to write().
+    """
+    entries = []
+    for data, status, check in objects:
+        obj = structures.Object()
+        obj.unpack(bytes(data))
+        entry = structures.DirectoryEntry()
+        entry.id = obj.id
+        entry.length = obj.length
+        entry.version = obj.version
+        entry.status = status
+        entry.check = check
+        entries.append((entry, obj._data))
+    entries.sort(key=lambda e: e[0].id.name)
+
+    maximum = max(dir_entries or 0, len(entries))
+    prologue = structures.Prologue()
+    directory = structures.Directory()
+    checks = structures.Check(0, 0)
+    head = b''
+    reserved = None
+    if template is not None:
+        prologue.unpack(template.prologue.pack())
+        tdir = template.dir
+        directory.createdate = tdir.createdate
+        directory.modifydate = tdir.modifydate
+        directory.novclass = tdir.novclass
+        checks = template.AUM.checks
+        maximum = max(maximum, tdir.maximum)
+        if prologue.austartoffset < prologue.size:
+            reserved = len(template.AUM.get_chain(prologue.prologuestartid))
+        head = template.read_offset(0, prologue.austartoffset +
+                                    (reserved or 0) * prologue.auquantasize)
+    else:
+        prologue.auquantasize = au_size
+        prologue.mapwidth = map_width or 8
+        prologue.prologuestartid = 2
+        directory.createdate = directory.modifydate = 0
+        directory.novclass = structures.VersionID(0, 0)
+    prologue.curstartidx = 0
+
+    directory.inuse = len(entries)
+    directory.maximum = maximum
+    directory.usageoff = 22
+    directory.entryoff = 22 + 2 * maximum
+    # TODO: check RS source for what the usage list really holds
+    directory.usagelist = list(range(len(entries))) + [-1] * (maximum -
+                                                              len(entries))
+    blank = structures.DirectoryEntry()
+    blank.unpack(bytes(blank.size))
+    directory.entrylist = ([entry for entry, data in entries] +
+                           [blank] * (maximum - len(entries)))
+    prologue.dirtotbytesize = max(prologue.dirtotbytesize, directory.size)
+    if prologue.dirtotbytesize > 0xffff:
+        raise structures.PackError('a directory of {} entries needs {} bytes '
+                                   'but the prologue only allows 65535'
+                                   .format(maximum, directory.size))
+
+    stage_writer = StageWriter(prologue, [directory, directory],
+                               [checks, checks], head=head,
+                               reserved=reserved)
+
+    # Work out how many entries the maps need. The maps are in the AUs
+    # they map so this has to settle.
+    auq = prologue.auquantasize
+    fixed = (prologue.prologuestartid + stage_writer.reserved +
+             2 * stage_writer.AU_count(prologue.dirtotbytesize) +
+             sum(stage_writer.AU_count(len(data))
+                 for entry, data in entries) + spare)
+    widths = ((prologue.mapwidth,) if template is not None or map_width
+              else (8, 12, 16))
+    for width in widths:
+        prologue.mapwidth = width
+        needed = fixed
+        while True:
+            aum_size = structures.AUM(prologue.mapwidth,
+                                      prologue.prologuestartid, needed).size
+            total = fixed + 2 * stage_writer.AU_count(aum_size)
+            if total <= needed:
+                break
+            needed = total
+        if max(prologue.maxmapentries, needed) <= 1 << width:
+            break
+    prologue.maxmapentries = max(prologue.maxmapentries, needed)
+    if prologue.maxmapentries > 1 << prologue.mapwidth:
+        raise structures.PackError('{} AUs needed but a {} bit map only '
+                                   'holds {}'
+                                   .format(prologue.maxmapentries,
+                                           prologue.mapwidth,
+                                           1 << prologue.mapwidth))
+
+    # Make room for the spare AUs too
+    stage_writer.length = (prologue.austartoffset +
+                           (prologue.maxmapentries -
+                            prologue.prologuestartid) * auq)
+
+    for obj_idx, (entry, data) in enumerate(entries):
+        chain = stage_writer.add_chain(data)
+        stage_writer.link(0, obj_idx, chain)
+        stage_writer.link(1, obj_idx, chain)
+    stage_writer.layout()
+    return stage_writer